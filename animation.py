@@ -5,8 +5,7 @@ import os
 import torch
 from torchvision import transforms
 from common.dataloader import *
-from torch.utils.data import DataLoader
-from common.pebrt import PEBRT
+from common.lifter import PoseLifter
 from common.human import *
 from tqdm import tqdm
 from PIL import Image
@@ -23,6 +22,7 @@ parser.add_argument("--action", type=str, default="Smoking")
 parser.add_argument("--dataset", type=str, default="../h36m/data_h36m_frame_all.npz")
 parser.add_argument("--device", default="cuda", help="device used")
 parser.add_argument("--checkpoint", help="path to pre-trained weights")
+parser.add_argument("--quantize", action="store_true", help="int8 dynamic quantization, runs on CPU")
 
 args = parser.parse_args()
 
@@ -50,26 +50,21 @@ def viz(args):
     print("Loading data")
 
     train_dataset = Data(args.dataset, transforms, train=False, action=args.action)
-    trainloader = DataLoader(train_dataset, batch_size=args.bs, \
+    trainloader = batch_loader(train_dataset, args.bs, \
                         shuffle=False, num_workers=8, drop_last=True)
     print("Data loaded!")
     dataiter = iter(trainloader)
-    img_path, kpts, _, _ = dataiter.next()
+    img_path, kpts, _, _ = next(dataiter)
     print(img_path)
     path = img_path[0].split("frame")[0]
     print(path)
 
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    model = PEBRT(device, num_layers=args.num_layers)
-    model.load_state_dict(torch.load(args.checkpoint)['model'])
+    lifter = PoseLifter.from_checkpoint(args.checkpoint, args.num_layers, device, \
+                        quantized=args.quantize, max_batch=args.bs)
     print("INFO: Loaded checkpoint from ", args.checkpoint)
-    model = model.to(device)
-    model.eval()
 
-    stack = {}
-    for k in tqdm(range(1,args.bs+1)):
-        output, _ = model(kpts[k-1].unsqueeze(0).to(device))
-        stack[k-1] = output.detach().cpu().numpy()
+    stack = {k: R_stack[None].numpy() for k, (R_stack, _) in enumerate(tqdm(lifter.stream(kpts), total=args.bs))}
 
     np.savez_compressed("pose_stack", stack)
     print("INFO: npz file saved. \n")
@@ -103,7 +98,7 @@ def animate(args, bones, format="mp4"):
     ax2.set_title('Reconstruction')
     ax2.view_init(elev=20, azim=80)
 
-    h = Human(1.7, "cpu")
+    h = Kinematics(1.7, "cpu")
     output = h.update_pose(data[0])
     output = output.detach().numpy()
 
@@ -121,7 +116,6 @@ def animate(args, bones, format="mp4"):
 
     def update(iter, data, bones):
         im.set_data(get_frame(path, file_list, iter))
-        h = Human(1.7, "cpu")
         out_pose = h.update_pose(data[iter])
         out_pose = out_pose.detach().numpy()
         for i in range(out_pose.shape[0]):
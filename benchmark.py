@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+"""
+CPU inference benchmarks of PEBRT on synthetic 2D keypoints
+"""
+from common.pebrt import *
+from common.export import *
+from common.lifter import PoseLifterPool
+
+import argparse
+import asyncio
+import numpy as np
+import json
+import os
+from time import perf_counter
+
+# options shared by all benchmarks, given after the benchmark name
+common = argparse.ArgumentParser(add_help=False)
+common.add_argument("--num_layers", type=int, default=2)
+common.add_argument("--checkpoint", type=str, default=None, help="Trained weights, random weights if not given")
+common.add_argument("--legacy_attention", action="store_true")
+common.add_argument("--bs", type=int, nargs="+", default=[1, 64, 512], help="Batch sizes to time")
+common.add_argument("--iters", type=int, default=50, help="Timed calls per batch size")
+common.add_argument("--threads", type=int, default=None, help="Number of torch CPU threads")
+common.add_argument("--joints", action="store_true", help="Include forward kinematics")
+
+parser = argparse.ArgumentParser("PEBRT inference benchmarks")
+subparsers = parser.add_subparsers(dest="command")
+latency_parser = subparsers.add_parser("latency", parents=[common], help="Eager model against TorchScript")
+latency_parser.add_argument("--compile", action="store_true", help="Also time torch.compile (PyTorch 2)")
+subparsers.add_parser("quantized", parents=[common], help="Parity and throughput of int8 dynamic quantization against the float model")
+onnx_parser = subparsers.add_parser("onnx", parents=[common], help="Parity and throughput of onnxruntime against the eager model")
+onnx_parser.add_argument("--path", type=str, default="pebrt.onnx", help="Where the ONNX model is exported")
+pool_parser = subparsers.add_parser("pool", parents=[common], help="Frames/s of process pool inference against a single process")
+pool_parser.add_argument("--workers", type=int, nargs="+", default=None, help="Worker counts to time (default: powers of 2 up to the core count)")
+pool_parser.add_argument("--frames", type=int, default=65536, help="Frames per call")
+pool_parser.set_defaults(iters=5, threads=None)
+load_parser = subparsers.add_parser("load", help="Load generator for serve.py")
+load_parser.add_argument("--host", type=str, default="127.0.0.1")
+load_parser.add_argument("--port", type=int, default=8000)
+load_parser.add_argument("--unix", type=str, default=None, help="Unix socket of the server instead of --host/--port")
+load_parser.add_argument("--concurrency", type=int, default=32, help="Concurrent connections")
+load_parser.add_argument("--requests", type=int, default=2000, help="Requests in total")
+load_parser.add_argument("--frames", type=int, default=1, help="Frames per request")
+load_parser.add_argument("--binary", action="store_true", help="Send and receive raw float32 instead of JSON")
+
+args = parser.parse_args()
+
+
+
+def load_model():
+    model = PEBRT("cpu", num_layers=args.num_layers, per_sample=not args.legacy_attention)
+    if args.checkpoint:
+        load_checkpoint(model, args.checkpoint, args.legacy_attention)
+    return model.eval()
+
+
+def timeit(fn, x, warmup=3):
+    """ :return: median latency of fn(x) in ms """
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(x)
+        times = []
+        for _ in range(args.iters):
+            start = perf_counter()
+            fn(x)
+            times.append(perf_counter() - start)
+    return np.median(times)*1000
+
+
+def latency(model):
+    runners = {
+        "eager": lambda x: model.infer(x, args.joints),
+        "torchscript": torch.jit.script(export_module(model, args.joints)),
+    }
+    if args.compile:
+        runners["compile"] = torch.compile(export_module(model, args.joints))
+
+    print("bs\t" + "\t".join("{} (ms)".format(name) for name in runners))
+    for bs in args.bs:
+        x = torch.randn(bs, 17, 2)
+        print("{}\t".format(bs) + "\t".join("{:.3f}".format(timeit(run, x)) for run in runners.values()))
+
+
+def onnx_parity(model):
+    save_onnx(model, args.path)
+    session = OnnxPEBRT(args.path, args.threads)
+
+    print("bs\tmax |dR|\tmax |dJ| (mm)\teager (poses/s)\tonnxruntime (poses/s)")
+    for bs in args.bs:
+        x = torch.randn(bs, 17, 2)
+        R, joints = model.infer(x, joints=True)
+        R_ort, joints_ort = session.infer(x, joints=True)
+        eager = bs / timeit(lambda x: model.infer(x, args.joints), x) * 1000
+        ort = bs / timeit(lambda x: session.infer(x, args.joints), x) * 1000
+        print("{}\t{:.2e}\t{:.2e}\t{:.0f}\t{:.0f}".format(bs, (R - R_ort).abs().max(), \
+                (joints - joints_ort).abs().max()*1000, eager, ort))
+
+
+def quantized(model):
+    model_int8 = quantize(model)
+
+    print("bs\tmax |dR|\tmax |dJ| (mm)\tfloat (poses/s)\tint8 (poses/s)")
+    for bs in args.bs:
+        x = torch.randn(bs, 17, 2)
+        R, joints = model.infer(x, joints=True)
+        R_int8, joints_int8 = model_int8.infer(x, joints=True)
+        fp32 = bs / timeit(lambda x: model.infer(x, args.joints), x) * 1000
+        int8 = bs / timeit(lambda x: model_int8.infer(x, args.joints), x) * 1000
+        print("{}\t{:.2e}\t{:.2e}\t{:.0f}\t{:.0f}".format(bs, (R - R_int8).abs().max(), \
+                (joints - joints_int8).abs().max()*1000, fp32, int8))
+
+
+def pool(model):
+    """ --threads is the thread count of each worker, the single process baseline uses all cores, both pose joints """
+    x = torch.randn(args.frames, 17, 2)
+    num_threads = args.threads or 1
+    workers = args.workers or [2**k for k in range(int(np.log2(os.cpu_count() // num_threads)) + 1)]
+    baseline = args.frames / timeit(lambda x: model.infer(x, joints=True), x) * 1000
+    R = model.infer(x)
+
+    print("single process ({} threads): {:.0f} frames/s".format(torch.get_num_threads(), baseline))
+    print("workers\tthreads\tmax |dR|\tframes/s\tspeedup")
+    for num_workers in workers:
+        with PoseLifterPool(model, num_workers=num_workers, num_threads=num_threads) as lifter:
+            R_pool, _ = lifter.lift(x)  # also waits for the workers to start
+            fps = args.frames / timeit(lifter.lift, x) * 1000
+        print("{}\t{}\t{:.2e}\t{:.0f}\t{:.2f}".format(num_workers, num_threads, \
+                (R - R_pool).abs().max(), fps, fps / baseline))
+
+
+async def http_request(reader, writer, method, path, body=b"", headers=None):
+    """ minimal HTTP/1.1 request on a kept-alive connection, :return status code, payload """
+    headers = dict(headers or {}, **{"Host": "localhost", "Content-Length": len(body)})
+    writer.write("{} {} HTTP/1.1\r\n{}\r\n".format(method, path, \
+                "".join("{}: {}\r\n".format(k, v) for k, v in headers.items())).encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":")[1])
+    return status, await reader.readexactly(length)
+
+
+async def load():
+    connect = (lambda: asyncio.open_unix_connection(args.unix)) if args.unix \
+            else (lambda: asyncio.open_connection(args.host, args.port))
+    kpts = np.random.randn(args.frames, 17, 2).astype(np.float32)
+    if args.binary:
+        body, headers = kpts.tobytes(), {"Content-Type": "application/octet-stream", "Accept": "application/octet-stream"}
+    else:
+        body, headers = json.dumps({"kpts": kpts.tolist()}).encode(), {"Content-Type": "application/json"}
+    latencies = []
+
+    async def client(num_requests):
+        reader, writer = await connect()
+        for _ in range(num_requests):
+            start = perf_counter()
+            status, payload = await http_request(reader, writer, "POST", "/lift", body, headers)
+            assert status == 200, payload
+            latencies.append(perf_counter() - start)
+        writer.close()
+
+    start = perf_counter()
+    await asyncio.gather(*[client(len(shard)) for shard in np.array_split(np.arange(args.requests), args.concurrency)])
+    elapsed = perf_counter() - start
+    print("{} requests in {:.2f} s: {:.0f} requests/s, {:.0f} frames/s".format(
+            len(latencies), elapsed, len(latencies)/elapsed, len(latencies)*args.frames/elapsed))
+    print("latency (ms): p50 {:.2f}, p90 {:.2f}, p99 {:.2f}".format(*np.percentile(latencies, [50, 90, 99])*1000))
+
+    reader, writer = await connect()
+    _, metrics = await http_request(reader, writer, "GET", "/metrics")
+    writer.close()
+    print(metrics.decode())
+
+
+if __name__ == "__main__":
+    if args.command == "load":
+        asyncio.run(load())
+        exit(0)
+    if args.threads and args.command != "pool":
+        torch.set_num_threads(args.threads)
+    commands = {"latency": latency, "onnx": onnx_parity, "quantized": quantized, "pool": pool}
+    if args.command not in commands:
+        parser.print_help()
+        exit(0)
+    commands[args.command](load_model())
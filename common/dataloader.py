@@ -1,25 +1,176 @@
+import os
+import json
 import numpy as np
 import cv2 as cv
 from common.human import *
 from common.misc import *
 
 
+# bump whenever the preprocessing in Data._build changes, to invalidate cached labels
+CACHE_VERSION = 4
+CACHE_FIELDS = ("path_dirs", "path_nums", "gt_pts2d", "gt_pts3d", "gt_vecs3d", "subjects", "actions", "frames")
+
+
+def batch_loader(dataset, batch_size=None, shuffle=False, drop_last=False, sampler=None, batches=None, **kwargs):
+    """
+    DataLoader that fetches a whole batch with one fancy-index (Data.__getitem__ on an index array)
+    instead of one call per frame followed by a collate.
+    :param sampler: optional frame sampler, e.g. DistributedSampler
+    :param batches: optional precomputed list of index arrays, replaces batch_size/shuffle/sampler
+    """
+    from torch.utils.data import BatchSampler, DataLoader, RandomSampler, SequentialSampler, Subset
+    if kwargs.get("num_workers", 0) > 0:
+        # hand labels to workers through shared memory instead of pickled copies
+        data = dataset.dataset if isinstance(dataset, Subset) else dataset
+        if hasattr(data, "share_memory"):
+            data.share_memory()
+    if batches is None:
+        if sampler is None:
+            sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        batches = BatchSampler(sampler, batch_size, drop_last)
+    return DataLoader(dataset, sampler=batches, batch_size=None, **kwargs)
+
+
+class ResidentLoader:
+    """
+    Loader over a dataset uploaded with Data.to(device): batches are drawn by indexing the device
+    tensors with an on-device permutation, without worker processes or host-to-device copies.
+    Takes the same batching arguments as batch_loader and yields (indices, kpts_2d, kpts_3d, vecs_3d),
+    with the frame indices on device in place of image paths.
+    """
+    def __init__(self, dataset, batch_size=None, shuffle=False, drop_last=False, sampler=None, batches=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.sampler = sampler
+        self.batches = batches
+
+
+    def __len__(self):
+        if self.batches is not None:
+            return len(self.batches)
+        n = len(self.sampler) if self.sampler is not None else len(self.dataset)
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+
+    def __iter__(self):
+        device = self.dataset.device
+        if self.batches is not None:
+            batches = (torch.as_tensor(idx, device=device) for idx in self.batches)
+        else:
+            if self.sampler is not None:
+                order = torch.as_tensor(list(self.sampler), device=device)
+            elif self.shuffle:
+                order = torch.randperm(len(self.dataset), device=device)
+            else:
+                order = torch.arange(len(self.dataset), device=device)
+            batches = order.split(self.batch_size)
+            if self.drop_last and len(order) % self.batch_size:
+                batches = batches[:-1]
+        for idx in batches:
+            yield (idx,) + tuple(labels[idx] for labels in self.dataset.resident)
+
+
+class PathTable:
+    """
+    Frame paths stored as a small table of templates (prefix, digit width, extension) plus
+    a template index and a frame number per frame, e.g. "./h36m/S9/Walking.54138969/frame000123.jpg"
+    is ("./h36m/S9/Walking.54138969/frame", 6, ".jpg") and 123.
+    Strings are only materialized when indexed with an int; indexing with an array gives another view.
+    """
+    def __init__(self, templates, dirs, nums):
+        self.templates = templates
+        self.dirs = dirs
+        self.nums = nums
+
+
+    @staticmethod
+    def compress(paths):
+        """
+        :param paths: list of path strings
+        :return templates, dirs (int32), nums (int64)
+        """
+        import re
+        pattern = re.compile(r"(.*?)(\d+)(\.\w+)$")
+        lookup, dirs, nums = {}, [], []
+        for path in paths:
+            match = pattern.match(path)
+            # paths without a frame number keep the whole string as prefix
+            template = (match.group(1), len(match.group(2)), match.group(3)) if match else (path, 0, "")
+            dirs.append(lookup.setdefault(template, len(lookup)))
+            nums.append(int(match.group(2)) if match else 0)
+        return [list(t) for t in lookup], np.array(dirs, dtype=np.int32), np.array(nums, dtype=np.int64)
+
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            prefix, width, ext = self.templates[self.dirs[index]]
+            return "{}{:0{}d}{}".format(prefix, self.nums[index], width, ext) if width else prefix + ext
+        return PathTable(self.templates, self.dirs[index], self.nums[index])
+
+
+    def __len__(self):
+        return len(self.dirs)
+
+
+    def __repr__(self):
+        return repr([self[i] for i in range(len(self))])
+
+
+def cache_key(npz_path, params) -> str:
+    """
+    hash of the identity of the source npz file (path, size, modification time) and the preprocessing
+    parameters, without reading the multi-GB file itself
+    """
+    import hashlib
+    stat = os.stat(npz_path)
+    source = {"path": os.path.abspath(npz_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    return hashlib.sha1(json.dumps([source, params], sort_keys=True).encode()).hexdigest()[:16]
+
+
 class Data:
-    def __init__(self, npz_path, transforms=None, train=True, action=None):
-        self.img_path = []
-        self.gt_pts2d = []
-        self.gt_pts3d = []
-        self.gt_vecs3d = []
+    def __init__(self, npz_path, transforms=None, train=True, action=None, cache_dir=None, rot_format="mat"):
+        """
+        :param cache_dir: where preprocessed labels are stored as .npy files and memory-mapped
+                          on later runs. Default: <npz directory>/cache, "" disables the cache.
+        :param rot_format: storage of GT rotations gt_vecs3d, "mat" (16,9), "6d" (16,6) or "quat" (16,4);
+                           compact ones are expanded by the losses (see compress_rot / expand_rot)
+        """
         self.transforms = transforms
+        self.rot_format = rot_format
+        self.dataset = "h36m" if "h36m" in npz_path else "mpi"
+        if self.dataset == "mpi" and action is not None:
+            print("Only support action parameter in H3.6M dataset.")
+            exit(0)
+
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(npz_path), "cache")
+        if not cache_dir:
+            self._build(npz_path, train, action)
+            return
+
+        params = {"version": CACHE_VERSION, "dataset": self.dataset, "train": train, "action": action, \
+                  "rot_format": rot_format}
+        path = os.path.join(cache_dir, cache_key(npz_path, params))
+        if not os.path.isfile(os.path.join(path, "meta.json")):
+            self._build(npz_path, train, action)
+            self._save_cache(path, params)
+        self._load_cache(path)
 
 
+    def _build(self, npz_path, train, action):
+        """ preprocess all frames of the npz file into label arrays """
+        img_path, gt_pts2d, gt_pts3d = [], [], []
+        subjects, actions, frame_ids = [], [], []
+        self.subject_names, self.action_names = [], []
+
         data = np.load(npz_path, allow_pickle=True)
         num_frame = 0
 
-        if "h36m" in npz_path:
+        if self.dataset == "h36m":
             # T pose
-            h = Human(1.8, "cpu", "h36m")
-            model = h.update_pose()
+            model = Kinematics(1.8, "cpu", "h36m").update_pose()
             t_info = vectorize(model)[:,:3]
 
             print("INFO: Using Human3.6M dataset.")
@@ -37,13 +188,20 @@ class Data:
                     to_load = [item for item in data.files \
                         for S in subject["subjects_test"] if S in item]
             else:
-                # evaluating
+                # evaluating, e.g. "Walking" matches "S9/Walking" and "S9/Walking 1" but not "S9/WalkTogether"
                 to_load = [item for item in data.files \
-                    for S in subject["subjects_test"] if S in item and action in item]
+                    for S in subject["subjects_test"] if S in item and item.split("/")[1].split(" ")[0] == action]
 
             import random
             random.seed(100)
             for act in to_load:
+                # e.g. "S9/Walking 1" -> subject "S9", action "Walking"
+                S, name = act.split("/")[0], act.split("/")[1].split(" ")[0]
+                if S not in self.subject_names:
+                    self.subject_names.append(S)
+                if name not in self.action_names:
+                    self.action_names.append(name)
+
                 frames = data[act].flatten()[0]
                 reduced = random.sample(list(frames), int(len(frames))) \
                     if action is None else random.sample(list(frames), int(len(frames)))
@@ -54,27 +212,26 @@ class Data:
                             frames[f]["positions_3d"], "h36m"))
 
                     assert gt_2d.shape == (17,2) and gt_3d.shape == (17,3)
-                    self.gt_pts2d.append(gt_2d)
-                    self.gt_pts3d.append(gt_3d)
-                    self.gt_vecs3d.append(convert_gt(gt_3d, t_info))
-                    self.img_path.append(frames[f]["directory"])
+                    gt_pts2d.append(gt_2d)
+                    gt_pts3d.append(gt_3d)
+                    img_path.append(frames[f]["directory"])
+                    subjects.append(self.subject_names.index(S))
+                    actions.append(self.action_names.index(name))
+                    frame_ids.append(f)
 
         else:
             # T pose
-            h = Human(1.8, "cpu", "mpi")
-            model = h.update_pose()
+            model = Kinematics(1.8, "cpu", "mpi").update_pose()
             t_info = vectorize(model)[:,:3]
 
-            if action is not None:
-                print("Only support action parameter in H3.6M dataset.")
-                exit(0)
             print("INFO: Using MPI-INF-3DHP dataset.")
             data = data["arr_0"].reshape(1,-1)[0]
             vid_list = np.arange(6)
             if not train:
                 vid_list = np.arange(6,8)
+            self.subject_names = ["video_{}".format(vid) for vid in vid_list]
 
-            for vid in vid_list:
+            for n, vid in enumerate(vid_list):
                 num_frame += len(data[vid].keys())
                 for frame in data[vid].keys():
                     pts_2d = data[vid][frame]["pts_2d"]
@@ -84,24 +241,147 @@ class Data:
                     cam_3d = self.to_camera_coordinate(pts_2d, pts_3d, vid)
                     gt_3d = self.zero_center(cam_3d)/1000
 
-                    self.gt_pts2d.append(gt_2d)
-                    self.gt_pts3d.append(gt_3d)
-                    self.gt_vecs3d.append((convert_gt(gt_3d, t_info)))
-                    self.img_path.append(data[vid][frame]["directory"])
+                    gt_pts2d.append(gt_2d)
+                    gt_pts3d.append(gt_3d)
+                    img_path.append(data[vid][frame]["directory"])
+                    subjects.append(n)
+                    actions.append(-1)
+                    frame_ids.append(frame)
 
-    def __getitem__(self, index):
+        self.path_templates, self.path_dirs, self.path_nums = PathTable.compress(img_path)
+        self.gt_pts2d = np.array(gt_pts2d, dtype=np.float32).reshape(-1,17,2)
+        self.gt_pts3d = np.array(gt_pts3d, dtype=np.float32).reshape(-1,17,3)
+        self.subjects = np.array(subjects, dtype=np.int16)
+        self.actions = np.array(actions, dtype=np.int16)
+        self.frames = np.array(frame_ids, dtype=np.int64)
+
+        # GT rotation matrices of all frames, converted in chunks to bound memory
+        chunk = 65536
+        dim = {"mat": 9, "6d": 6, "quat": 4}[self.rot_format]
+        self.gt_vecs3d = np.zeros([num_frame, 16, dim], dtype=np.float32)
+        for start in range(0, num_frame, chunk):
+            R = torch.from_numpy(convert_gt(self.gt_pts3d[start:start+chunk], t_info))
+            self.gt_vecs3d[start:start+chunk] = compress_rot(R, self.rot_format).numpy()
+
+
+    def _save_cache(self, path, params):
+        """ write label arrays as uncompressed .npy files, atomically per cache entry """
+        import shutil, tempfile
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(path))
+        for field in CACHE_FIELDS:
+            np.save(os.path.join(tmp, field + ".npy"), getattr(self, field))
+        meta = dict(params, subject_names=self.subject_names, action_names=self.action_names, \
+                    path_templates=self.path_templates)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(meta, f)
         try:
-            img_path = self.img_path[index]
-            kpts_2d = self.gt_pts2d[index]
-            kpts_3d = self.gt_pts3d[index]
-            vecs_3d = self.gt_vecs3d[index]
-        except:
-            return None
+            os.rename(tmp, path)
+            print("INFO: Preprocessed labels cached in {}".format(path))
+        except OSError:
+            # another process cached the same labels first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+    def _load_cache(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.subject_names, self.action_names = meta["subject_names"], meta["action_names"]
+        self.path_templates = meta["path_templates"]
+        for field in CACHE_FIELDS:
+            setattr(self, field, np.load(os.path.join(path, field + ".npy"), mmap_mode="c"))
+        print("INFO: Loaded {} preprocessed frames from {}".format(len(self), path))
+
+
+    @property
+    def img_path(self):
+        """ lazy view on the frame paths, see PathTable """
+        return PathTable(self.path_templates, self.path_dirs, self.path_nums)
+
+
+    def indices(self, action=None, subject=None) -> np.array:
+        """
+        Frame indices of one action and/or subject, matched exactly (e.g. "Sitting" excludes "SittingDown")
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if action is not None:
+            mask &= self.actions == (self.action_names.index(action) if action in self.action_names else -2)
+        if subject is not None:
+            mask &= self.subjects == (self.subject_names.index(subject) if subject in self.subject_names else -2)
+        return np.flatnonzero(mask)
+
+
+    def subset(self, action=None, subject=None):
+        """ a view on the frames of one action and/or subject, without reloading the dataset """
+        return torch.utils.data.Subset(self, self.indices(action, subject))
+
+
+    def to(self, device):
+        """
+        Upload 2D/3D keypoints and GT rotations to device once, to be batched by ResidentLoader
+        """
+        self.device = torch.device(device)
+        self.resident = tuple(torch.as_tensor(np.asarray(labels), device=self.device) \
+                            for labels in (self.gt_pts2d, self.gt_pts3d, self.gt_vecs3d))
+        return self
+
+
+    def share_memory(self):
+        """
+        Move in-memory label arrays to shared memory, so DataLoader workers (also spawned ones)
+        map the same pages instead of each receiving a pickled copy.
+        Arrays memory-mapped from the cache are already shared and are reopened by path in workers.
+        """
+        self._shared = getattr(self, "_shared", {})
+        for field in CACHE_FIELDS:
+            labels = getattr(self, field)
+            if isinstance(labels, np.memmap) or field in self._shared:
+                continue
+            labels = np.ascontiguousarray(labels)
+            buffer = torch.from_numpy(labels.reshape(-1).view(np.uint8)).share_memory_()
+            self._shared[field] = (buffer, labels.dtype.str, labels.shape)
+            setattr(self, field, buffer.numpy().view(labels.dtype).reshape(labels.shape))
+        return self
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # device-resident labels are only batched in the main process
+        state.pop("resident", None)
+        state.pop("device", None)
+        for field in CACHE_FIELDS:
+            labels = state[field]
+            if isinstance(labels, np.memmap) and labels.filename is not None:
+                state[field] = ("mmap", labels.filename)
+            elif field in state.get("_shared", {}):
+                state[field] = ("shared",)
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for field in CACHE_FIELDS:
+            labels = state[field]
+            if isinstance(labels, tuple) and labels[0] == "mmap":
+                setattr(self, field, np.load(labels[1], mmap_mode="c"))
+            elif isinstance(labels, tuple) and labels[0] == "shared":
+                buffer, dtype, shape = self._shared[field]
+                setattr(self, field, buffer.numpy().view(dtype).reshape(shape))
+
+
+    def __getitem__(self, index):
+        """
+        :param index: a frame index, or an array of indices to fetch a whole batch at once (see batch_loader)
+        """
+        img_path = self.img_path[index]
+        kpts_2d = self.gt_pts2d[index]
+        kpts_3d = self.gt_pts3d[index]
+        vecs_3d = self.gt_vecs3d[index]
         return img_path, kpts_2d, kpts_3d, vecs_3d
         
 
     def __len__(self):
-        return len(self.img_path)
+        return len(self.path_dirs)
     
 
     def remove_joints(self, kpts, dataset="mpi"):
@@ -13,25 +13,19 @@ class PositionalEncoder(nn.Module):
         super().__init__()
         self.d_model = d_model
         self.dropout = nn.Dropout(dropout)
-        pe = torch.zeros(max_seq_len, d_model)
-        for pos in range(max_seq_len):
-            for i in range(0, d_model, 2):
-                pe[pos, i] = math.sin(pos / (10000 ** ((2 * i)/d_model)))
-                pe[pos, i + 1] = math.cos(pos / (10000 ** ((2 * (i + 1))/d_model)))
-
-        self.pe = pe
+        pos = np.arange(max_seq_len, dtype=np.float64)[:,None]
+        i = np.arange(d_model, dtype=np.float64)
+        angles = pos / np.power(10000, (2 * i)/d_model)
+        pe = np.where(i % 2 == 0, np.sin(angles), np.cos(angles))
+        # not persistent, so it moves with the module without changing its state_dict
+        self.register_buffer("pe", torch.from_numpy(pe).to(torch.float32), persistent=False)
  
     def forward(self, x):
-        bs, seq_len, d_model = x.size(0), x.size(1), x.size(2)
-        x *= math.sqrt(d_model)
-        pe = self.pe[:seq_len, :d_model]
-        pe_all = pe.repeat(bs, 1, 1)
-        pe_all = pe_all.to(x.device)
-
-        assert x.shape == pe_all.shape, "{},{}".format(x.shape, pe_all.shape)
-        assert x.device == pe_all.device, "{},{}".format(x.device, pe_all.device)
-        x += pe_all
-        return x
+        """
+        :param x: (bs,seq_len,d_model) tensor, left untouched
+        """
+        seq_len, d_model = x.size(1), x.size(2)
+        return x * math.sqrt(d_model) + self.pe[:seq_len, :d_model]
 
 
 if __name__ == "__main__":
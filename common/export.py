@@ -0,0 +1,121 @@
+import inspect
+import torch
+import torch.nn as nn
+from typing import Tuple
+from common.human import *
+from common.pebrt import *
+
+
+class PEBRTRotations(nn.Module):
+    """
+    Inference graph of PEBRT.infer without Python-side logic, for TorchScript / torch.compile:
+    encoder -> tanh -> Gram-Schmidt, (bs,17,2) keypoints to (bs,16,9) rotation matrices
+    """
+    def __init__(self, model: PEBRT):
+        super().__init__()
+        self.transformer = model.transformer
+
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = self.transformer(x.float())
+        return gram_schmidt(x.view(-1,16,6))
+
+
+class PEBRTJoints(nn.Module):
+    """
+    PEBRTRotations followed by forward kinematics with joint limits, as PEBRT.infer(x, joints=True)
+    :return: (bs,16,9) rotation matrices and (bs,17,3) joints
+    """
+    def __init__(self, model: PEBRT):
+        super().__init__()
+        self.rotations = PEBRTRotations(model)
+        self.kinematics = model.kinematics
+
+
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        R_stack = self.rotations(x)
+        R, _ = self.kinematics.check_constraints(R_stack.view(-1,16,3,3))
+        return R_stack, self.kinematics(R)
+
+
+def export_module(model: PEBRT, joints=False) -> nn.Module:
+    """ the exportable inference graph of a (trained) PEBRT, in eval mode """
+    module = PEBRTJoints(model) if joints else PEBRTRotations(model)
+    return module.eval()
+
+
+def save_torchscript(model: PEBRT, path, joints=False):
+    """
+    Script the inference graph and save it, to be run with torch.jit.load(path)(kpts_2d)
+    without this repository.
+    """
+    scripted = torch.jit.script(export_module(model, joints))
+    scripted.save(path)
+    print("INFO: TorchScript model saved to", path)
+    return scripted
+
+
+def save_onnx(model: PEBRT, path, opset_version=None):
+    """
+    Export encoder -> tanh -> Gram-Schmidt to ONNX with a dynamic batch axis:
+    input "kpts_2d" (bs,17,2), output "rotations" (bs,16,9).
+    Forward kinematics stays out of the graph, its float64 joint limit pass has no onnxruntime kernels.
+    The TorchScript exporter bakes the sample batch size into the reshapes of nn.MultiheadAttention,
+    so this needs the dynamo exporter (PyTorch >= 2.5, with the onnx and onnxscript packages).
+    """
+    if "dynamo" not in inspect.signature(torch.onnx.export).parameters:
+        raise RuntimeError("ONNX export with a dynamic batch axis needs PyTorch >= 2.5, found " + torch.__version__)
+    module = export_module(model)
+    x = torch.randn(2, 17, 2, device=next(module.parameters()).device)
+    torch.onnx.export(module, (x,), path, input_names=["kpts_2d"], output_names=["rotations"],
+                    dynamic_shapes={"x": {0: torch.export.Dim("bs", min=1)}},
+                    opset_version=opset_version, dynamo=True)
+    print("INFO: ONNX model saved to", path)
+
+
+def check_onnx(model: PEBRT, path, batch_sizes=(1, 7), atol=1e-4):
+    """
+    Compare the graph saved by save_onnx with PEBRT.infer on batch sizes other than the export sample
+    :return: max absolute difference of the rotations
+    """
+    session = OnnxPEBRT(path)
+    device = next(model.parameters()).device
+    error = 0.0
+    for bs in batch_sizes:
+        x = torch.randn(bs, 17, 2)
+        R = model.infer(x.to(device)).cpu()
+        R_ort = session.infer(x)
+        if R_ort.shape != R.shape:
+            raise RuntimeError("ONNX model returned {} for batch size {}".format(tuple(R_ort.shape), bs))
+        error = max(error, (R - R_ort).abs().max().item())
+    if error > atol:
+        raise RuntimeError("ONNX model differs from PEBRT.infer by {:.2e}".format(error))
+    print("INFO: ONNX model matches PEBRT.infer for batch sizes", batch_sizes)
+    return error
+
+
+class OnnxPEBRT:
+    """
+    onnxruntime CPU session of a graph saved by save_onnx, with the inference call of PEBRT
+    """
+    def __init__(self, path, num_threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.kinematics = Kinematics(1.8, "cpu")
+
+
+    def infer(self, x, joints=False):
+        """
+        Same as PEBRT.infer, joints are posed on the CPU
+        :param x: (bs,17,2) 2D keypoints, tensor or array
+        :return R_stack: (bs,16,9) tensor, and (bs,17,3) joints if joints
+        """
+        x = x.detach().cpu().numpy() if torch.is_tensor(x) else x
+        R_stack = self.session.run(["rotations"], {"kpts_2d": np.asarray(x, dtype=np.float32)})[0]
+        R_stack = torch.from_numpy(R_stack)
+        if not joints:
+            return R_stack
+        return R_stack, self.kinematics.update_pose(R_stack).view(-1,17,3)
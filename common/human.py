@@ -1,35 +1,228 @@
 import numpy as np
 import cmath
 import torch
-
-
-def rot(euler: tuple) -> torch.tensor:
+import torch.nn as nn
+import torch.nn.functional as F
+from typing import Optional
+
+
+# 16 bones in the order of Human.constraints / NN outputs
+BONES = (
+    "lower_spine", "upper_spine", "neck", "head",
+    "l_clavicle", "l_upper_arm", "l_lower_arm",
+    "r_clavicle", "r_upper_arm", "r_lower_arm",
+    "l_hip", "l_thigh", "l_calf",
+    "r_hip", "r_thigh", "r_calf",
+)
+
+# (start joint, end joint) of each bone in the (17,3) layout of Human.update_pose
+BONE_JOINTS = (
+    (2,1), (1,0), (0,3), (3,4),  # spine + head
+    (0,5), (5,6), (6,7),
+    (0,8), (8,9), (9,10), # arms
+    (2,11), (11,12), (12,13),
+    (2,14), (14,15), (15,16), # legs
+)
+BONE_INDEX = torch.tensor(BONE_JOINTS)
+
+
+# joint rotation limits ((low,high) in rad for ZYX) of each bone
+CONSTRAINTS = {
+    "h36m": {
+        "lower_spine": ((-0.52,0.61), (-0.61,0.61), (-0.52,1.31)),
+        "upper_spine": ((0,0), (0,0), (0,1.66)),
+        "neck": ((0,0), (0,0), (0,1.22)),
+        "head": ((-1.22,1.22), (-0.61,0.61), (-0.96,1.39)),
+
+        "l_clavicle": ((0,0), (0,0), (0,0)), #4
+        "l_upper_arm": ((-2.27,0.707), (-2.28,1.57), (-1.57,3.14)),
+        "l_lower_arm": ((-2.62,0), (0,0), (0,0)),
+        "r_clavicle": ((0,0), (0,0), (0,0)),
+        "r_upper_arm": ((-0.707,2.27), (-1.57,2.28), (-1.57,3.14)),
+        "r_lower_arm": ((0,2.62), (0,0), (0,0)),
+
+        "l_hip": ((0,0), (0,0), (0,0)), #10
+        "l_thigh": ((-0.785,0.785), (-0.87,0.35), (-2.09,0.52)),
+        "l_calf": ((0,0), (0,0), (0,2.79)),
+        "r_hip": ((0,0), (0,0), (0,0)),
+        "r_thigh": ((-0.785,0.785), (-0.35,0.87), (-2.09,0.52)),
+        "r_calf": ((0,0), (0,0), (0,2.79)),
+    },
+    "mpi": {
+        "lower_spine": ((-0.61,0.61), (-0.52,0.52), (-0.52,1.31)),
+        "upper_spine": ((0,0), (0,0), (0,1.66)),
+        "neck": ((0,0), (0,0), (0,1.22)),
+        "head": ((-0.61,0.61), (-1.22,1.22), (-0.96,1.39)),
+
+        "l_clavicle": ((0,0), (0,0), (0,0)), #4
+        "l_upper_arm": ((-1.57,2.28), (-0.707,2.27), (-1.57,3.14)),
+        "l_lower_arm": ((0,0), (0,2.62), (0,0)),
+        "r_clavicle": ((0,0), (0,0), (0,0)),
+        "r_upper_arm": ((-2.28,1.57), (-2.27,0.707), (-1.57,3.14)),
+        "r_lower_arm": ((0,0), (-2.62,0), (0,0)),
+
+        "l_hip": ((0,0), (0,0), (0,0)), #10
+        "l_thigh": ((-0.87,0.35), (-0.785,0.785), (-2.09,0.52)),
+        "l_calf": ((0,0), (0,0), (0,2.79)),
+        "r_hip": ((0,0), (0,0), (0,0)),
+        "r_thigh": ((-0.35,0.87), (-0.785,0.785), (-2.09,0.52)),
+        "r_calf": ((0,0), (0,0), (0,2.79)),
+    },
+}
+
+# child : parent, for bones constrained relative to their parent
+CHILD = {
+    "upper_spine": "lower_spine",
+    "head": "neck",
+    "l_lower_arm": "l_upper_arm",
+    "r_lower_arm": "r_upper_arm",
+    "l_calf": "l_thigh",
+    "r_calf": "r_thigh",
+}
+
+
+def rot(euler) -> torch.tensor:
     """
     General rotation matrix
-    :param euler: (a, b, r) rotation in rad in ZYX
+    :param euler: (a, b, r) rotation in rad in ZYX, or a (...,3) tensor of them
     
-    :return R: a rotation matrix R
+    :return R: a rotation matrix R (3,3), or (...,3,3) for batched angles
     """
-    from math import sin, cos
-    a, b, r = euler[0], euler[1], euler[2]
-    row1 = torch.tensor([cos(a)*cos(b), cos(a)*sin(b)*sin(r)-sin(a)*cos(r), cos(a)*sin(b)*cos(r)+sin(a)*sin(r)])
-    row2 = torch.tensor([sin(a)*cos(b), sin(a)*sin(b)*sin(r)+cos(a)*cos(r), sin(a)*sin(b)*cos(r)-cos(a)*sin(r)])
-    row3 = torch.tensor([-sin(b), cos(b)*sin(r), cos(b)*cos(r)])
-    R = torch.stack((row1, row2, row3), 0)
-    assert cmath.isclose(torch.linalg.det(R), 1, rel_tol=1e-04), torch.linalg.det(R)
+    angles = euler if torch.is_tensor(euler) else torch.from_numpy(np.asarray(euler, dtype=np.float64))
+    R = _rot(angles)
+    if not torch.is_tensor(euler):
+        R = R.to(torch.float32)
+        assert cmath.isclose(torch.linalg.det(R), 1, rel_tol=1e-04), torch.linalg.det(R)
     return R
 
 
-def rot_to_euler(R: np.array) -> np.array:
+def _rot(angles: torch.Tensor) -> torch.Tensor:
+    """ rot on a (...,3) tensor, scriptable """
+    a, b, r = angles.unbind(-1)
+    ca, sa, cb, sb, cr, sr = a.cos(), a.sin(), b.cos(), b.sin(), r.cos(), r.sin()
+    R = torch.stack((
+        ca*cb, ca*sb*sr-sa*cr, ca*sb*cr+sa*sr,
+        sa*cb, sa*sb*sr+ca*cr, sa*sb*cr-ca*sr,
+        -sb, cb*sr, cb*cr), -1)
+    return R.view(list(angles.shape[:-1]) + [3,3])
+
+
+def _givens(s, c):
+    """ normalized (sin, cos) of a Givens rotation, as in cv.RQDecomp3x3 """
+    z = torch.rsqrt(c*c + s*s + 2.220446049250313e-16) # float64 eps
+    return s*z, c*z
+
+
+def _sign(x):
+    """ 1 for x >= 0, -1 otherwise """
+    return (x >= 0).to(x.dtype)*2 - 1
+
+
+def rot_to_euler(R):
     """
-    :return: Euler angles in rad in ZYX
+    Closed-form equivalent of cv.RQDecomp3x3 on (3,3) or (N,3,3) rotation matrices.
+    Applies the same Givens rotations (x, then y, then z) and swaps the result to ZYX.
+    :return: Euler angles in rad in ZYX, (3,) or (N,3)
+              (NumPy if R is a NumPy array, otherwise a tensor on R's device)
     """
-    import cv2 as cv
-    if torch.is_tensor(R):
-        R = R.detach().cpu().numpy()
-    angles = np.radians(cv.RQDecomp3x3(R)[0])
-    angles[0], angles[2] = angles[2], angles[0]
-    return angles
+    angles = _rot_to_euler(torch.as_tensor(R).to(torch.float64))
+    if not torch.is_tensor(R):
+        return angles.numpy()
+    return angles.to(R.dtype) if R.is_floating_point() else angles
+
+
+def _rot_to_euler(M: torch.Tensor) -> torch.Tensor:
+    """ rot_to_euler on a (...,3,3) float64 tensor, scriptable """
+    m10, m11, m12 = M[...,1,0], M[...,1,1], M[...,1,2]
+    m20, m21, m22 = M[...,2,0], M[...,2,1], M[...,2,2]
+
+    # Qx zeroes (2,1) of M
+    sx, cx = _givens(m21, m22)
+    r11, r12 = m11*cx - m12*sx, m11*sx + m12*cx
+    r22 = m21*sx + m22*cx
+    # Qy zeroes (2,0) of M @ Qx
+    sy, cy = _givens(-m20, r22)
+    # Qz zeroes (1,0) of M @ Qx @ Qy
+    sz, cz = _givens(m10*cy + r12*sy, r11)
+
+    return torch.stack((
+        torch.acos(cz) * _sign(sz),
+        torch.acos(cy) * _sign(sy),
+        torch.acos(cx) * _sign(sx)), -1)
+
+
+def gram_schmidt(arr: torch.Tensor) -> torch.Tensor:
+    """
+    Detail implementation of Gram-Schmidt orthogonalization
+    :param arr: a (...,6) tensor, the first two columns of each rotation matrix
+    :return Rs: flattened rotation matrices, i.e. (...,9)
+    """
+    a_1, a_2 = arr[...,:3], arr[...,3:]
+    row_1 = F.normalize(a_1, dim=-1)
+    dot = torch.sum((row_1*a_2),dim=-1).unsqueeze(-1)
+    row_2 = F.normalize(a_2 - dot*row_1, dim=-1)
+    row_3 = torch.cross(row_1, row_2, dim=-1)
+    R = torch.cat((row_1, row_2, row_3), -1) # stack + transpose
+    shape = list(arr.shape[:-1])
+    R = R.view(shape + [3,3]).transpose(-1,-2)
+    return R.reshape(shape + [9])
+
+
+def rot_to_quat(R) -> torch.tensor:
+    """
+    Unit quaternions (w,x,y,z), w >= 0, of rotation matrices
+    :param R: (...,9) flattened rotation matrices
+    :return q: (...,4)
+    """
+    m00, m01, m02, m10, m11, m12, m20, m21, m22 = R.unbind(-1)
+    # row k is 4*q_k*q, use the one with the largest q_k for numerical stability
+    candidates = torch.stack((
+        torch.stack((1+m00+m11+m22, m21-m12, m02-m20, m10-m01), -1),
+        torch.stack((m21-m12, 1+m00-m11-m22, m01+m10, m02+m20), -1),
+        torch.stack((m02-m20, m01+m10, 1-m00+m11-m22, m12+m21), -1),
+        torch.stack((m10-m01, m02+m20, m12+m21, 1-m00-m11+m22), -1)), -2)
+    best = torch.diagonal(candidates, dim1=-2, dim2=-1).argmax(-1)
+    q = torch.gather(candidates, -2, best[...,None,None].expand(*best.shape,1,4)).squeeze(-2)
+    q = F.normalize(q, dim=-1)
+    return torch.where(q[...,:1] < 0, -q, q)
+
+
+def quat_to_rot(q) -> torch.tensor:
+    """
+    :param q: (...,4) quaternions (w,x,y,z), normalized here
+    :return R: (...,9) flattened rotation matrices
+    """
+    w, x, y, z = F.normalize(q, dim=-1).unbind(-1)
+    return torch.stack((
+        1-2*(y*y+z*z), 2*(x*y-w*z), 2*(x*z+w*y),
+        2*(x*y+w*z), 1-2*(x*x+z*z), 2*(y*z-w*x),
+        2*(x*z-w*y), 2*(y*z+w*x), 1-2*(x*x+y*y)), -1)
+
+
+def compress_rot(R, rot_format="mat"):
+    """
+    :param R: (...,9) tensor of flattened rotation matrices
+    :param rot_format: "mat" (9 values), "6d" (first two columns, as consumed by gram_schmidt) or "quat"
+    :return: (...,9), (...,6) or (...,4) tensor
+    """
+    if rot_format == "6d":
+        return R.view(*R.shape[:-1],3,3)[...,:2].transpose(-1,-2).reshape(*R.shape[:-1],6)
+    if rot_format == "quat":
+        return rot_to_quat(R)
+    assert rot_format == "mat", rot_format
+    return R
+
+
+def expand_rot(rot):
+    """
+    Inverse of compress_rot, the format is told by the last dimension
+    :return R: (...,9) tensor of flattened rotation matrices
+    """
+    if rot.size(-1) == 6:
+        return gram_schmidt(rot)
+    if rot.size(-1) == 4:
+        return quat_to_rot(rot)
+    return rot
 
 
 class Human:
@@ -47,59 +240,11 @@ class Human:
         self.thigh, self.calf = 0.245*H, 0.246*H
         self.root = torch.zeros(3, device=self.device)
 
-        self.child = {
-            # child : parent
-            "upper_spine": "lower_spine",
-            "head": "neck",
-            "l_lower_arm": "l_upper_arm",
-            "r_lower_arm": "r_upper_arm",
-            "l_calf": "l_thigh",
-            "r_calf": "r_thigh",
-        }
+        self.child = CHILD
 
     def _fetch_constraints(self):
-        if self.human == "h36m":
-            self.constraints = {
-                "lower_spine": ((-0.52,0.61), (-0.61,0.61), (-0.52,1.31)),
-                "upper_spine": ((0,0), (0,0), (0,1.66)),
-                "neck": ((0,0), (0,0), (0,1.22)),
-                "head": ((-1.22,1.22), (-0.61,0.61), (-0.96,1.39)),
-
-                "l_clavicle": ((0,0), (0,0), (0,0)), #4
-                "l_upper_arm": ((-2.27,0.707), (-2.28,1.57), (-1.57,3.14)),
-                "l_lower_arm": ((-2.62,0), (0,0), (0,0)),
-                "r_clavicle": ((0,0), (0,0), (0,0)),
-                "r_upper_arm": ((-0.707,2.27), (-1.57,2.28), (-1.57,3.14)),
-                "r_lower_arm": ((0,2.62), (0,0), (0,0)),
-
-                "l_hip": ((0,0), (0,0), (0,0)), #10
-                "l_thigh": ((-0.785,0.785), (-0.87,0.35), (-2.09,0.52)),
-                "l_calf": ((0,0), (0,0), (0,2.79)),
-                "r_hip": ((0,0), (0,0), (0,0)),
-                "r_thigh": ((-0.785,0.785), (-0.35,0.87), (-2.09,0.52)),
-                "r_calf": ((0,0), (0,0), (0,2.79)),
-            }
-        elif self.human == "mpi":
-            self.constraints = {
-                "lower_spine": ((-0.61,0.61), (-0.52,0.52), (-0.52,1.31)),
-                "upper_spine": ((0,0), (0,0), (0,1.66)),
-                "neck": ((0,0), (0,0), (0,1.22)),
-                "head": ((-0.61,0.61), (-1.22,1.22), (-0.96,1.39)),
-
-                "l_clavicle": ((0,0), (0,0), (0,0)), #4
-                "l_upper_arm": ((-1.57,2.28), (-0.707,2.27), (-1.57,3.14)),
-                "l_lower_arm": ((0,0), (0,2.62), (0,0)),
-                "r_clavicle": ((0,0), (0,0), (0,0)),
-                "r_upper_arm": ((-2.28,1.57), (-2.27,0.707), (-1.57,3.14)),
-                "r_lower_arm": ((0,0), (-2.62,0), (0,0)),
-
-                "l_hip": ((0,0), (0,0), (0,0)), #10
-                "l_thigh": ((-0.87,0.35), (-0.785,0.785), (-2.09,0.52)),
-                "l_calf": ((0,0), (0,0), (0,2.79)),
-                "r_hip": ((0,0), (0,0), (0,0)),
-                "r_thigh": ((-0.35,0.87), (-0.785,0.785), (-2.09,0.52)),
-                "r_calf": ((0,0), (0,0), (0,2.79)),
-            }
+        if self.human in CONSTRAINTS:
+            self.constraints = CONSTRAINTS[self.human]
         else:
             print("Unrecognized dataset name.")
 
@@ -253,30 +398,129 @@ class Human:
         return self.model
 
 
+class Kinematics(nn.Module):
+    """
+    Batched forward kinematics of the Winter human model.
+    Uses the same T-pose and bone chain as Human.update_pose, but poses a whole
+    batch with one matmul (rotate bones) and one chain summation (assemble joints).
+    """
+    def __init__(self, H=1.8, device="cpu", human="h36m"):
+        super().__init__()
+        h = Human(H, device, human)
+        h._init_bones()
+        offsets = torch.stack([h.bones[bone] for bone in BONES], 0).float() # (16,3)
+
+        # chain[j,k] = 1 if bone k lies on the path from root to joint j
+        chain = torch.zeros(17, len(BONES), device=offsets.device)
+        for k, (start, end) in enumerate(BONE_JOINTS):
+            chain[end] = chain[start]
+            chain[end, k] = 1
+
+        # (16,3,2) joint limits and parent bone index (-1 if constrained on absolute angles)
+        limits = torch.tensor([CONSTRAINTS[human][bone] for bone in BONES], dtype=torch.float64)
+        parents = torch.tensor([BONES.index(CHILD[bone]) if bone in CHILD else -1 for bone in BONES])
+
+        self.human = human
+        self.register_buffer("offsets", offsets, persistent=False)
+        self.register_buffer("chain", chain, persistent=False)
+        self.register_buffer("limits", limits.to(offsets.device), persistent=False)
+        self.register_buffer("parents", parents.to(offsets.device), persistent=False)
+        self.register_buffer("child_bones", torch.nonzero(parents >= 0).flatten().to(offsets.device), persistent=False)
+
+
+    def check_range(self, angles, bones: Optional[torch.Tensor] = None):
+        """
+        Batched Human.check_range
+        :param angles: (bs,k,3) Euler angles (ZYX) of the selected bones
+        :param bones: (k,) indices of the selected bones, all 16 if None
+        :return angles: (bs,k,3) clamped angles
+        :return punish_w: (bs,k) 1 + number of clamped axes
+        """
+        limits = self.limits if bones is None else self.limits[bones]
+        limits = limits.to(angles)
+        low, high = limits[...,0], limits[...,1]
+        free = high != low
+        rounded = torch.round(angles*1000)/1000
+        under = free & (rounded < low)
+        over = free & ~under & (rounded > high)
+        angles = torch.where(under, low, torch.where(over, high, angles))
+        punish_w = 1 + (under | over).sum(-1)
+        return angles, punish_w
+
+
+    def check_constraints(self, R: torch.Tensor):
+        """
+        Batched Human.sort_rot: clamp each bone to its joint limits (child bones
+        relative to their clamped parent) and punish by adding weights.
+        :param R: (bs,16,3,3) rotation matrices
+        :return R: (bs,16,3,3) clamped rotation matrices
+        :return w_kc: (bs,16) punishing weights
+        """
+        bs = R.size(0)
+        absolute_angles = _rot_to_euler(R.reshape(-1,3,3).double()).view(bs,16,3)
+        aug_angles, punish_w = self.check_range(absolute_angles)
+        R_out = F.normalize(_rot(aug_angles).to(R.dtype), dim=-1)
+
+        children = self.child_bones.to(R.device)
+        parent_R = R_out[:,self.parents.to(R.device)[children]]
+        parent_angles = _rot_to_euler(parent_R.reshape(-1,3,3).double()).view(bs,-1,3)
+        relative_angles = absolute_angles[:,children] - parent_angles
+        aug_angles, child_w = self.check_range(relative_angles, self.child_bones)
+        child_R = F.normalize(_rot(aug_angles + parent_angles).to(R.dtype), dim=-1)
+
+        R_out = R_out.index_copy(1, children, child_R)
+        punish_w = punish_w.index_copy(1, children, child_w)
+        return R_out, punish_w.to(R.dtype)
+
+
+    def bone_vectors(self, R: torch.Tensor) -> torch.Tensor:
+        """
+        :param R: (bs,16,3,3) rotation matrices
+        :return: (bs,16,3) rotated bone vectors
+        """
+        offsets = self.offsets.to(R)
+        return torch.einsum("bkij,kj->bki", R, offsets)
+
+
+    def forward(self, R: torch.Tensor) -> torch.Tensor:
+        """
+        :param R: (bs,16,3,3) rotation matrices
+        :return: (bs,17,3) joints
+        """
+        bones = self.bone_vectors(R)
+        return torch.einsum("jk,bki->bji", self.chain.to(bones), bones)
+
+
+    def update_pose(self, elem=None) -> torch.tensor:
+        """
+        Drop-in for Human.update_pose on a single pose or a batch of poses:
+        clamps the rotations to joint limits, then assembles the bones.
+        :param elem: None (T-pose), 144 elements for one pose, or (bs,16,9) / (bs,16,3,3)
+        :return model: (17,3) for a single pose, otherwise (bs,17,3)
+        """
+        if elem is None:
+            return self.chain @ self.offsets
+        R = elem if torch.is_tensor(elem) else torch.from_numpy(np.asarray(elem))
+        single = R.numel() == 144
+        R, _ = self.check_constraints(R.reshape(-1,16,3,3))
+        model = self(R)
+        return model[0] if single else model
+
+
 def vectorize(gt_3d) -> torch.tensor:
     """
-    process gt_3d (17,3) into a (16,4) that contains bone vector and length
+    process gt_3d (17,3) into a (16,4) that contains bone vector and length,
+    or a whole array of poses (N,17,3) into (N,16,4)
     :return bone_info: [unit bone vector (,3) + bone length (,1)]
     """
-    indices = (
-        (2,1), (1,0), (0,3), (3,4),  # spine + head
-        (0,5), (5,6), (6,7), 
-        (0,8), (8,9), (9,10), # arms
-        (2,11), (11,12), (12,13),
-        (2,14), (14,15), (15,16), # legs
-    )
-
-    num_bones = len(indices)
     gt_3d_tensor = gt_3d if torch.is_tensor(gt_3d) \
-                    else torch.from_numpy(gt_3d)
-
-    bone_info = torch.zeros([num_bones, 4], requires_grad=False) # (16, 4)
-    for i in range(num_bones):
-        vec = gt_3d_tensor[indices[i][1],:] - gt_3d_tensor[indices[i][0],:]
-        vec_len = torch.linalg.norm(vec)
-        unit_vec = vec/vec_len
-        bone_info[i,:3], bone_info[i,3] = unit_vec, vec_len
-    return bone_info
+                    else torch.from_numpy(np.asarray(gt_3d))
+
+    vec = gt_3d_tensor[...,BONE_INDEX[:,1],:] - gt_3d_tensor[...,BONE_INDEX[:,0],:]
+    vec_len = torch.linalg.norm(vec, dim=-1, keepdim=True)
+    unit_vec = vec/vec_len
+    bone_info = torch.cat((unit_vec, vec_len), -1)
+    return bone_info.to(torch.float32)
 
 
 # functions below are for demonstration and debuggging purpose
@@ -0,0 +1,360 @@
+import os
+import json
+import queue
+import zipfile
+import threading
+import multiprocessing
+from tqdm import tqdm
+from time import perf_counter
+from common.pebrt import *
+
+
+class KeypointArchive:
+    """
+    2D keypoints (N,17,2) (or (N,34)) of an .npy file or of one array of an .npz archive, read in chunks
+    without loading the whole array: .npy files are memory-mapped, .npz members are streamed from the zip.
+    """
+    def __init__(self, path, key=None):
+        """
+        :param key: array of an .npz archive, may be omitted if the archive holds a single array
+        """
+        self.path = path
+        self.key = key
+        if path.endswith(".npz"):
+            with zipfile.ZipFile(path) as archive:
+                names = [name[:-4] for name in archive.namelist() if name.endswith(".npy")]
+            if key is None:
+                if len(names) != 1:
+                    raise ValueError("{} holds arrays {}, choose one as key".format(path, names))
+                self.key = names[0]
+            elif key not in names:
+                raise KeyError("{} not in {}, arrays are {}".format(key, path, names))
+            with self.open_member() as f:
+                self.shape, self.dtype, _ = self.read_header(f)
+        else:
+            self.array = np.load(path, mmap_mode="r")
+            self.shape, self.dtype = self.array.shape, self.array.dtype
+
+        if self.dtype.hasobject or int(np.prod(self.shape[1:])) != 34:
+            raise ValueError("{} is not an array of (17,2) keypoints: {} {}".format(path, self.dtype, self.shape))
+
+
+    def open_member(self):
+        return zipfile.ZipFile(self.path).open(self.key + ".npy")
+
+
+    @staticmethod
+    def read_header(f):
+        """ :return shape, dtype and byte offset of the data of an .npy stream """
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        if fortran_order:
+            raise ValueError("Fortran ordered arrays are not supported")
+        return shape, dtype, f.tell()
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def chunks(self, size, start=0):
+        """ :return: generator of (offset, (n,17,2) float32 array) from frame start on """
+        if self.key is None:
+            for k in range(start, len(self), size):
+                yield k, np.array(self.array[k:k+size], dtype=np.float32).reshape(-1,17,2)
+            return
+
+        frame_bytes = 34*self.dtype.itemsize
+        with self.open_member() as f:
+            _, _, header = self.read_header(f)
+            # forward seek, compressed members are decompressed up to start
+            f.seek(header + start*frame_bytes)
+            for k in range(start, len(self), size):
+                n = min(size, len(self) - k)
+                buffer = f.read(n*frame_bytes)
+                if len(buffer) != n*frame_bytes:
+                    raise EOFError("{} ends at frame {}".format(self.path, k + len(buffer)//frame_bytes))
+                yield k, np.frombuffer(buffer, dtype=self.dtype).astype(np.float32).reshape(-1,17,2)
+
+
+def checkpoint_config(checkpoint, model, quantized=False) -> dict:
+    """ :return: the checkpoint (path and mtime) and options a PoseLifter was built with """
+    config = {"num_layers": len(model.transformer.transformer.layers), "quantized": quantized, \
+                "legacy_attention": not model.transformer.per_sample}
+    if isinstance(checkpoint, str):
+        config.update(checkpoint=os.path.abspath(checkpoint), checkpoint_mtime_ns=os.stat(checkpoint).st_mtime_ns)
+    return config
+
+
+def is_output(path, shape) -> bool:
+    """ :return: path is a complete float32 .npy array of this shape """
+    try:
+        array = np.load(path, mmap_mode="r")
+    except (OSError, ValueError):
+        # missing, or truncated below its header's shape
+        return False
+    return array.shape == shape and array.dtype == np.float32
+
+
+class PoseLifter:
+    """
+    Streaming inference of a trained PEBRT: 2D keypoint frames go in, rotations and joints come out
+    in the same order. Frames are lifted in micro-batches of at most max_batch frames, and a batch waits
+    at most max_wait seconds after its first frame for more frames to arrive.
+    """
+    def __init__(self, model, device="cpu", max_batch=64, max_wait=0.01):
+        """
+        :param model: PEBRT in eval mode, or any model with the same infer(x, joints) (e.g. OnnxPEBRT)
+        """
+        self.model = model
+        self.device = torch.device(device)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        # what produces the outputs, checked before lift_archive resumes (set by from_checkpoint)
+        self.config = {}
+        if not getattr(getattr(model, "transformer", None), "per_sample", True):
+            # poses of a batch would attend to each other
+            print("INFO: Legacy attention, lifting one frame at a time")
+            self.max_batch = 1
+
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint, num_layers=2, device="cpu", quantized=False, legacy_attention=False, **kwargs):
+        """
+        :param checkpoint: weights saved by lift.py
+        :param quantized: int8 dynamic quantization, on CPU (see quantize)
+        :param kwargs: max_batch, max_wait
+        """
+        model = PEBRT(device, num_layers=num_layers)
+        load_checkpoint(model, checkpoint, legacy_attention)
+        model = model.to(device).eval()
+        config = checkpoint_config(checkpoint, model, quantized)
+        if quantized:
+            model, device = quantize(model), "cpu"
+        lifter = cls(model, device, **kwargs)
+        lifter.config = config
+        return lifter
+
+
+    def lift(self, kpts):
+        """
+        :param kpts: (bs,17,2) 2D keypoints, or a single (17,2) pose
+        :return R_stack: (bs,16,9) rotation matrices, (bs,17,3) joints, CPU tensors (without bs for a single pose)
+        Inputs of more than max_batch frames are lifted max_batch frames at a time, one by one for legacy attention.
+        """
+        x = kpts if torch.is_tensor(kpts) else torch.from_numpy(np.asarray(kpts, dtype=np.float32))
+        single = x.dim() == 2
+        x = x.view(-1,17,2).to(self.device)
+        if len(x) <= self.max_batch:
+            R_stack, joints = self.model.infer(x, joints=True)
+        else:
+            R_stack, joints = map(torch.cat, zip(*[self.model.infer(x[k:k+self.max_batch], joints=True) \
+                                for k in range(0, len(x), self.max_batch)]))
+        R_stack, joints = R_stack.cpu(), joints.cpu()
+        return (R_stack[0], joints[0]) if single else (R_stack, joints)
+
+
+    def stream(self, frames):
+        """
+        :param frames: iterable of (17,2) keypoints, e.g. a live camera feed, read on a background thread
+        :return: generator of (R_stack (16,9), joints (17,3)) per frame, in order
+        """
+        source = queue.Queue(maxsize=2*self.max_batch)
+        done, error = object(), []
+        stop = threading.Event()
+
+        def put(item):
+            """ :return: False once the consumer has stopped """
+            while not stop.is_set():
+                try:
+                    source.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read():
+            try:
+                for frame in frames:
+                    if not put(frame):
+                        break
+            except Exception as e:
+                error.append(e)
+            finally:
+                if stop.is_set() and hasattr(frames, "close"):
+                    # release e.g. a camera held by a generator
+                    frames.close()
+                put(done)
+
+        threading.Thread(target=read, daemon=True).start()
+        try:
+            finished = False
+            while not finished:
+                batch = [source.get()]
+                if batch[0] is done:
+                    break
+                deadline = perf_counter() + self.max_wait
+                while len(batch) < self.max_batch:
+                    try:
+                        frame = source.get(timeout=max(deadline - perf_counter(), 0))
+                    except queue.Empty:
+                        break
+                    if frame is done:
+                        finished = True
+                        break
+                    batch.append(frame)
+
+                x = torch.stack([torch.as_tensor(np.asarray(frame, dtype=np.float32)) for frame in batch])
+                R_stack, joints = self.lift(x)
+                yield from zip(R_stack, joints)
+        finally:
+            # also when the consumer breaks out early, so the reader lets go of the source
+            stop.set()
+
+        if error:
+            raise error[0]
+
+
+    def lift_archive(self, source, out_dir, chunk_size=65536, key=None):
+        """
+        Lift every frame of a keypoint archive into preallocated memory-mapped outputs, with constant memory:
+        out_dir/rotations.npy (N,16,9) and out_dir/joints.npy (N,17,3), float32.
+        Lifted frames are recorded in out_dir/progress.json after each chunk, an interrupted run resumes
+        from there when called again with the same source and lifter (checkpoint and options, see config),
+        if both outputs are still complete. Otherwise it starts over.
+        :param source: .npy file or .npz archive of 2D keypoints, see KeypointArchive
+        :param chunk_size: frames read, lifted and written per step
+        :return: number of frames lifted
+        """
+        archive = KeypointArchive(source, key)
+        N = len(archive)
+        os.makedirs(out_dir, exist_ok=True)
+        progress_path = os.path.join(out_dir, "progress.json")
+        progress = {"source": os.path.abspath(source), "key": archive.key, "frames": N, "model": self.config, "offset": 0}
+        outputs = {os.path.join(out_dir, name + ".npy"): (N,) + shape for name, shape in (("rotations", (16,9)), ("joints", (17,3)))}
+
+        mode = "w+"
+        if os.path.exists(progress_path):
+            with open(progress_path) as f:
+                saved = json.load(f)
+            if any(saved.get(k) != progress[k] for k in ("source", "key", "frames")):
+                print("INFO: {} belongs to another source, starting over".format(progress_path))
+            elif saved.get("model") != self.config:
+                print("INFO: {} was written by another checkpoint or options, starting over".format(out_dir))
+            elif not all(is_output(path, shape) for path, shape in outputs.items()):
+                print("INFO: Outputs in {} are missing or incomplete, starting over".format(out_dir))
+            else:
+                progress["offset"], mode = saved["offset"], "r+"
+                print("INFO: Resuming {} from frame {}/{}".format(source, saved["offset"], N))
+
+        outputs = [np.lib.format.open_memmap(path, mode=mode, dtype=np.float32, shape=shape) for path, shape in outputs.items()]
+
+        num_chunks = -(-(N - progress["offset"]) // chunk_size)
+        for offset, kpts in tqdm(archive.chunks(chunk_size, progress["offset"]), total=num_chunks):
+            for k in range(0, len(kpts), self.max_batch):
+                R_stack, joints = self.lift(kpts[k:k+self.max_batch])
+                outputs[0][offset+k:offset+k+len(R_stack)] = R_stack.numpy()
+                outputs[1][offset+k:offset+k+len(joints)] = joints.numpy()
+            for output in outputs:
+                output.flush()
+            # written only once the chunk is on disk
+            progress["offset"] = offset + len(kpts)
+            with open(progress_path + ".tmp", "w") as f:
+                json.dump(progress, f)
+            os.replace(progress_path + ".tmp", progress_path)
+
+        del outputs
+        return N
+
+
+# model of a PoseLifterPool worker process
+_worker_lifter = None
+
+
+def _init_worker(state, num_layers, per_sample, quantized, max_batch, num_threads):
+    """ rebuild the float model from its weights in the worker, quantized ones do not pickle across processes """
+    global _worker_lifter
+    torch.set_num_threads(num_threads)
+    model = PEBRT("cpu", num_layers=num_layers, per_sample=per_sample)
+    model.load_state_dict({k: torch.from_numpy(v) for k, v in state.items()})
+    model = model.eval()
+    if quantized:
+        model = quantize(model)
+    _worker_lifter = PoseLifter(model, max_batch=max_batch)
+
+
+def _lift_shard(kpts):
+    R_stack, joints = _worker_lifter.lift(kpts)
+    return R_stack.numpy(), joints.numpy()
+
+
+class PoseLifterPool(PoseLifter):
+    """
+    Data-parallel CPU inference: the frames of a lift call are sharded across a pool of worker processes,
+    each with its own copy of the model and num_threads intra-op threads, and merged back in order.
+    On many-core machines this scales better than one process with many threads on a model as small as PEBRT.
+    """
+    def __init__(self, model, device="cpu", num_workers=None, num_threads=1, max_batch=65536, max_wait=0.01, \
+                    shard_size=None, quantized=False):
+        """
+        :param model: float PEBRT, left untouched, the workers load a copy of its weights
+        :param quantized: workers run an int8 dynamically quantized copy (see quantize)
+        :param num_workers: worker processes, default one per core (os.cpu_count() // num_threads)
+        :param num_threads: torch threads of each worker
+        :param shard_size: frames per task, default an even split of each call across the workers
+        """
+        super().__init__(model, "cpu", max_batch, max_wait)
+        self.num_workers = num_workers or max(1, (os.cpu_count() or 1) // num_threads)
+        self.shard_size = 1 if self.max_batch == 1 else shard_size
+        # plain arrays, each worker gets its own copy of the weights
+        state = {k: v.detach().cpu().numpy() for k, v in model.state_dict().items()}
+        initargs = (state, len(model.transformer.transformer.layers), model.transformer.per_sample, \
+                    quantized, self.max_batch, num_threads)
+        # spawn, forked workers would inherit the OpenMP state of the parent
+        context = multiprocessing.get_context("spawn")
+        self.pool = context.Pool(self.num_workers, initializer=_init_worker, initargs=initargs)
+
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint, num_layers=2, device="cpu", quantized=False, legacy_attention=False, **kwargs):
+        """ same as PoseLifter.from_checkpoint, quantization happens in the workers """
+        model = PEBRT("cpu", num_layers=num_layers)
+        load_checkpoint(model, checkpoint, legacy_attention)
+        lifter = cls(model.eval(), "cpu", quantized=quantized, **kwargs)
+        lifter.config = checkpoint_config(checkpoint, model, quantized)
+        return lifter
+
+
+    def lift(self, kpts):
+        """ same as PoseLifter.lift """
+        x = kpts.cpu().numpy() if torch.is_tensor(kpts) else np.asarray(kpts, dtype=np.float32)
+        single = x.ndim == 2
+        x = x.reshape(-1,17,2)
+        if self.shard_size:
+            shards = [x[k:k+self.shard_size] for k in range(0, len(x), self.shard_size)]
+        else:
+            shards = np.array_split(x, max(1, min(len(x), self.num_workers)))
+        # imap keeps the order of the shards
+        R_stack, joints = zip(*self.pool.imap(_lift_shard, shards))
+        R_stack, joints = torch.from_numpy(np.concatenate(R_stack)), torch.from_numpy(np.concatenate(joints))
+        return (R_stack[0], joints[0]) if single else (R_stack, joints)
+
+
+    def close(self, terminate=False):
+        """ :param terminate: stop the workers without waiting for pending shards """
+        if terminate:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, *exc):
+        self.close(terminate=exc_type is not None)
@@ -1,5 +1,5 @@
-import cmath
 import torch
+import torch.nn.functional as F
 from common.human import *
 
 
@@ -18,60 +18,72 @@ def mpjpe(predicted, target):
 
 
 
-def is_so(M):
-    det = cmath.isclose(torch.linalg.det(M), 1, rel_tol=1e-03)
-    orth = cmath.isclose(torch.linalg.det(M@M.T), 1, rel_tol=1e-03)
-    return 1 if orth and det else 2
+def is_so(M, rel_tol=1e-03):
+    """
+    Check if matrices are in SO(3), i.e. det(M) and det(M@M.T) are close to 1
+    :param M: (...,3,3) tensor, e.g. (bs,16,3,3)
+    :return: (...) weight tensor, 1 for valid rotation matrices, 2 otherwise
+    """
+    def isclose(x):
+        # same as cmath.isclose(x, 1, rel_tol=rel_tol)
+        return (x - 1).abs() <= rel_tol*torch.clamp(x.abs(), min=1)
+    det = isclose(torch.linalg.det(M))
+    orth = isclose(torch.linalg.det(M @ M.transpose(-1,-2)))
+    return 2 - (orth & det).to(M.dtype)
 
 
-def maev(predicted, target, w_kc=None):
+def maev(predicted, target, w_kc=None, use_orth: bool = False):
     """
     MAEV: Mean Absolute Error of Vectors
     :param predicted: (bs,16,9) tensor
-    :param target:  (bs,16,9) tensor
+    :param target:  (bs,16,9) tensor, or compact (bs,16,6) / (bs,16,4) GT (see compress_rot)
     :param w_kc: weight of kinematic constraints
+    :param use_orth: switch, if True also weight each bone by its SO(3) validity (see is_so), 2 for invalid ones.
+                     Gram-Schmidt outputs are always valid rotations, so PEBRT predictions get weight 1
     average error of 16 bones
     """
     bs, num_bones = predicted.size(0), predicted.size(1)
-    predicted = predicted.view(bs,num_bones,3,3)
-    target = target.view(bs,num_bones,3,3)
-    w_orth = torch.ones(target.shape[:2])
-    for b in range(bs):
-        for bone in range(num_bones):
-            M = predicted[b,bone]
-            w_orth[b,bone] = is_so(M)
     if torch.cuda.is_available():
         predicted = predicted.cuda()
         target = target.cuda()
-        w_orth = w_orth.cuda()
         w_kc = w_kc.cuda() if w_kc is not None else w_kc
+    predicted = predicted.view(bs,num_bones,3,3)
+    target = expand_rot(target).view(bs,num_bones,3,3)
     aev = torch.norm(torch.norm(predicted - target, dim=len(target.shape)-2), dim=len(target.shape)-2)
+    if use_orth:
+        aev = aev*is_so(predicted.detach())
     maev = torch.mean(aev*w_kc) if w_kc is not None else torch.mean(aev)
     return maev
 
 
+# kinematic models of mpbve, built once per device
+_kinematics = {}
+
+
+def get_kinematics(device) -> Kinematics:
+    if device not in _kinematics:
+        _kinematics[device] = Kinematics(1.8, device)
+    return _kinematics[device]
+
+
 def mpbve(predicted, target, w_kc):
     """
     MPBVE - Mean Per Bone Vector Error
     Novel pose accuracy evaluation metric-
     Normalize each bone to 1m and calculate the mean L2 norms
     :param predicted: (bs,16,9) tensor
-    :param target:  (bs,16,9) tensor
+    :param target:  (bs,16,9) tensor, or compact (bs,16,6) / (bs,16,4) GT (see compress_rot)
     """
     if torch.cuda.is_available():
         predicted = predicted.cuda()
         target = target.cuda()
     bs, num_bones = predicted.size(0), predicted.size(1)
 
-    pred_info = torch.zeros(bs, num_bones, 3)
-    tar_info = torch.zeros(bs, num_bones, 3)
-
-    for b in range(bs):
-        pred = Human(1.8, "cpu")
-        pred_model = pred.update_pose(predicted[b])
-        pred_info[b,:] = vectorize(pred_model)[:,:3]
-        tar = Human(1.8, "cpu")
-        tar_model = tar.update_pose(target[b])
-        tar_info[b,:] = vectorize(tar_model)[:,:3]
+    # pose both batches on the kinematic model (with joint limits) and compare unit bone vectors
+    kinematics = get_kinematics(predicted.device)
+    R = torch.cat((predicted, expand_rot(target).to(predicted)), 0).view(-1,num_bones,3,3)
+    R, _ = kinematics.check_constraints(R)
+    bone_info = F.normalize(kinematics.bone_vectors(R), dim=-1)
+    pred_info, tar_info = bone_info[:bs], bone_info[bs:]
     mpbve = torch.mean(torch.norm(pred_info - tar_info, dim=len(tar_info.shape)-1))
     return mpbve
@@ -11,19 +11,36 @@ def collate_fn(batch):
 def get_rot_from_vecs(vec1: np.array, vec2: np.array) -> np.array:
     """ 
     Find the rotation matrix that aligns vec1 to vec2
-    :param vec1: A 3d "source" vector
-    :param vec2: A 3d "destination" vector
+    :param vec1: A 3d "source" vector, or an (...,3) array of them
+    :param vec2: A 3d "destination" vector, or an (...,3) array of them
 
-    :return R: A transform matrix (3x3) which when applied to vec1, aligns it with vec2.
+    :return R: A transform matrix (3x3), or (...,3,3), which when applied to vec1, aligns it with vec2.
     
     Such that vec2 = R @ vec1
+    Parallel vectors give the identity, antiparallel ones a half turn about an axis normal to vec1.
     """
-    a, b = (vec1 / np.linalg.norm(vec1)).reshape(3), (vec2 / np.linalg.norm(vec2)).reshape(3)
+    vec1, vec2 = np.broadcast_arrays(np.asarray(vec1, dtype=np.float64), np.asarray(vec2, dtype=np.float64))
+    a = vec1 / np.linalg.norm(vec1, axis=-1, keepdims=True)
+    b = vec2 / np.linalg.norm(vec2, axis=-1, keepdims=True)
     v = np.cross(a, b)
-    c = np.dot(a, b)
-    s = np.linalg.norm(v)
-    kmat = np.array([[0, -v[2], v[1]], [v[2], 0, -v[0]], [-v[1], v[0], 0]])
-    R = np.eye(3) + kmat + kmat.dot(kmat) * ((1 - c) / (s ** 2))
+    c = np.sum(a*b, axis=-1)
+
+    kmat = np.zeros(v.shape + (3,))
+    kmat[...,0,1], kmat[...,0,2] = -v[...,2], v[...,1]
+    kmat[...,1,0], kmat[...,1,2] = v[...,2], -v[...,0]
+    kmat[...,2,0], kmat[...,2,1] = -v[...,1], v[...,0]
+    # Rodrigues: (1 - c) / s**2 == 1 / (1 + c), finite for parallel vectors
+    antiparallel = 1 + c < 1e-8
+    scale = 1 / np.where(antiparallel, 1, 1 + c)
+    R = np.eye(3) + kmat + (kmat @ kmat) * scale[...,None,None]
+
+    if np.any(antiparallel):
+        # rotate by pi about an axis orthogonal to a
+        a_ap = a[antiparallel]
+        helper = np.eye(3)[np.argmin(np.abs(a_ap), axis=-1)]
+        axis = np.cross(a_ap, helper)
+        axis /= np.linalg.norm(axis, axis=-1, keepdims=True)
+        R[antiparallel] = 2 * axis[...,:,None] * axis[...,None,:] - np.eye(3)
     return R
 
 
@@ -31,15 +48,13 @@ def convert_gt(gt_3d: np.array, t_info) -> np.array:
     """
     Compare GT3D kpts with T pose and obtain 16 rotation matrices
 
-    :return R_stack: a (16,9) arrays with flattened rotation matrix for 16 bones
+    :param gt_3d: a (17,3) pose, or an (N,17,3) array of poses
+    :return R_stack: a (16,9) arrays with flattened rotation matrix for 16 bones, or (N,16,9)
     """
     # process GT
-    bone_info = vectorize(gt_3d)[:,:3] # (16,3) bone vecs
+    bone_info = vectorize(gt_3d)[...,:3].numpy() # (16,3) bone vecs
+    t_info = t_info.numpy() if torch.is_tensor(t_info) else t_info
 
-    num_row = bone_info.shape[0]
-    R_stack = np.zeros([num_row, 9])
     # get rotation matrix for each bone
-    for k in range(num_row):
-        R = get_rot_from_vecs(t_info[k,:], bone_info[k,:]).flatten()
-        R_stack[k,:] = R
-    return R_stack
+    R_stack = get_rot_from_vecs(t_info, bone_info)
+    return R_stack.reshape(*R_stack.shape[:-2], 9)
@@ -11,7 +11,11 @@ class TransformerEncoder(nn.Module):
     Pose Estimation with Transformer
     """
     def __init__(self, d_model=34, nhead=2, num_layers=8, 
-                    num_joints_in=17, num_joints_out=17):
+                    num_joints_in=17, num_joints_out=17, per_sample=True):
+        """
+        :param per_sample: every pose is a sequence of its own. If False (legacy), the batch is fed as
+                           one sequence, so poses attend to each other and outputs depend on the batch.
+        """
         super().__init__()
 
         print("INFO: Using default positional encoder")
@@ -25,12 +29,18 @@ class TransformerEncoder(nn.Module):
         self.nhead = nhead
         self.num_joints_in = num_joints_in
         self.num_joints_out = num_joints_out 
+        self.per_sample = per_sample
 
 
     def forward(self, x):
         x = x.flatten(1).unsqueeze(1)
         x = self.pe(x)
-        x = self.transformer(x)
+        if self.per_sample:
+            # (1,bs,d_model): sequences of length 1, batched along dim 1
+            x = self.transformer(x.transpose(0,1)).transpose(0,1)
+        else:
+            # (bs,1,d_model) is read as a single sequence of bs poses
+            x = self.transformer(x)
         x = self.lin_out(x).squeeze(1)
         x = self.tanh(x)
 
@@ -41,12 +51,13 @@ class PEBRT(nn.Module):
     """
     PEBRT - Pose Estimation via Bone Rotation using Transformer
     """
-    def __init__(self, device, bs=1, num_layers=2):
+    def __init__(self, device, bs=1, num_layers=2, per_sample=True):
         super().__init__()
         
         self.bs = bs
         self.device = device
-        self.transformer = TransformerEncoder(num_layers=num_layers).to(device)
+        self.transformer = TransformerEncoder(num_layers=num_layers, per_sample=per_sample).to(device)
+        self.kinematics = Kinematics(1.8, device)
         print("INFO: Using {} layers of Transformer Encoder.".format(num_layers))
 
  
@@ -56,19 +67,11 @@ class PEBRT(nn.Module):
 
     def gram_schmidt(self, arr) -> torch.tensor:
         """
-        Detail implementation of Gram-Schmidt orthogonalization
-        :param arr: a tensor of shape (16,6)
-        :return Rs: a stack of flattened rotation matrix, i.e. (16,9)
+        Detail implementation of Gram-Schmidt orthogonalization, see common.human.gram_schmidt
+        :param arr: a tensor of shape (N,6), e.g. all bones of a batch (bs*16,6)
+        :return Rs: a stack of flattened rotation matrix, i.e. (N,9)
         """
-        import torch.nn.functional as F
-        a_1, a_2 = arr[:,:3], arr[:,3:]
-        row_1 = F.normalize(a_1, dim=1)
-        dot = torch.sum((row_1*a_2),dim=1).unsqueeze(1)
-        row_2 = F.normalize(a_2 - dot*row_1, dim=1)
-        row_3 = torch.cross(row_1, row_2)
-        R = torch.cat((row_1, row_2, row_3), 1) # stack + transpose
-        R = R.view(-1,3,3).transpose(1,2)
-        return R.reshape(-1,9)
+        return gram_schmidt(arr)
 
 
     def process(self, arr_all):
@@ -77,23 +80,16 @@ class PEBRT(nn.Module):
         1) project 6D to SO(3) via Gram-Schmidt process
         2) impose the recovered SO(3) on kinematic model and punish according to kinematic constraints
 
-        :param arr: a (96,) tensor, 6D representation of 16 bones
-        :return R_stack: (bs,16,9)
-        :return w_kc: (bs, 16)
+        :param arr: a (bs,96) tensor, 6D representation of 16 bones
+        :return R_stack: (bs,16,9), on the device of arr
+        :return w_kc: (bs, 16), on the device of arr
         """
         arr_all = arr_all.to(torch.float32).view(-1,16,6)
-        R_stack = torch.zeros(arr_all.size(0),16,9)
-        w_kc = torch.ones(arr_all.size(0),16)
-
-        for b in range(arr_all.size(0)):
-            arr = arr_all[b,:]
-            assert arr.size(1) == 6
-            R = self.gram_schmidt(arr)
-            R_stack[b,:] = R.to(self.device)
-            # Impose NN outputs SO(3) on kinematic model and get punishing weights
-            h = Human(1.8, "cpu")
-            h.update_pose(R_stack[b,:,:].flatten())
-            w_kc[b,:] = torch.tensor(h.punish_list)
+        R_stack = self.gram_schmidt(arr_all.view(-1,6)).view(-1,16,9)
+
+        # Impose NN outputs SO(3) on kinematic model and get punishing weights
+        with torch.no_grad():
+            _, w_kc = self.kinematics.check_constraints(R_stack.view(-1,16,3,3))
         return R_stack, w_kc
 
 
@@ -103,3 +99,58 @@ class PEBRT(nn.Module):
 
         return x, w_kc
 
+
+    @torch.no_grad()
+    def infer(self, x, joints=False):
+        """
+        Inference without the kinematic constraint weights of forward
+        :param x: (bs,17,2) 2D keypoints
+        :param joints: also pose the rotations on the kinematic model (with joint limits)
+        :return R_stack: (bs,16,9), and (bs,17,3) joint positions if joints
+        """
+        x = self.transformer(x.float())
+        R_stack = gram_schmidt(x.to(torch.float32).view(-1,16,6))
+        if not joints:
+            return R_stack
+        return R_stack, self.kinematics.update_pose(R_stack).view(-1,17,3)
+
+
+def quantize(model):
+    """
+    Copy of a PEBRT for CPU inference, with int8 dynamic quantization of the Linear layers of
+    the encoder (feed-forward blocks) and lin_out. Attention projections stay in float.
+    """
+    import copy
+    try:
+        from torch.ao.quantization import quantize_dynamic
+    except ImportError:
+        # PyTorch < 1.10
+        from torch.quantization import quantize_dynamic
+    model = copy.deepcopy(model).cpu().eval()
+    model.device = torch.device("cpu")
+    model.transformer = quantize_dynamic(model.transformer, {nn.Linear}, dtype=torch.qint8)
+    print("INFO: Using int8 dynamic quantization of the encoder")
+    return model
+
+
+def load_checkpoint(model, checkpoint, legacy_attention=False):
+    """
+    Load weights saved by lift.py into a PEBRT model.
+    Checkpoints without "legacy_attention" in their args were trained attending across the batch,
+    so the model is switched to that mode for them.
+    :param checkpoint: path or loaded checkpoint dict
+    :return checkpoint: the loaded dict
+    """
+    if isinstance(checkpoint, str):
+        try:
+            # the args Namespace saved by lift.py is refused by the weights_only default of PyTorch >= 2.6
+            checkpoint = torch.load(checkpoint, map_location="cpu", weights_only=False)
+        except TypeError:
+            # PyTorch < 1.13 has no weights_only
+            checkpoint = torch.load(checkpoint, map_location="cpu")
+    legacy_attention = legacy_attention or getattr(checkpoint.get("args"), "legacy_attention", True)
+    if legacy_attention:
+        print("INFO: Using legacy attention across the batch")
+    model.transformer.per_sample = not legacy_attention
+    model.load_state_dict(checkpoint["model"])
+    return checkpoint
@@ -4,11 +4,12 @@ from common.pebrt import *
 from common.dataloader import *
 from common.loss import *
 from common.human import *
+from common.export import *
+from common.lifter import PoseLifter, PoseLifterPool
 
 import argparse
 from tqdm import tqdm
 import torch.optim as optim
-from torch.utils.data import DataLoader
 from time import time
 
 parser = argparse.ArgumentParser("Set PEBRT parameters", add_help=False)
@@ -21,16 +22,37 @@ parser.add_argument("--num_layers", type=int, default=2)
 parser.add_argument("--lr", type=float, default=2e-04)
 parser.add_argument("--weight_decay", type=float, default=1e-05)
 parser.add_argument("--lr_drop", default=10, type=int)
+parser.add_argument("--use_orth", "--w_orth", action="store_true", help="Weight MAEV by SO(3) validity of predicted rotations")
 
 # Transformer (layers of enc and dec, dropout rate, num_heads, dim_feedforward)
 parser.add_argument("--dropout", type=float, default=0.1, help="Dropout rate applied in transformer")
 
+parser.add_argument("--legacy_attention", action="store_true", \
+                    help="Attend across the batch as before per-sample attention (set automatically for old checkpoints)")
+
 # dataset
 parser.add_argument("--num_workers", default=1, type=int)
+parser.add_argument("--pin_memory", action="store_true", help="Use pinned host memory for DataLoader batches")
+parser.add_argument("--persistent_workers", action="store_true", help="Keep DataLoader workers alive between epochs")
+parser.add_argument("--prefetch_factor", default=2, type=int, help="Batches prefetched by each DataLoader worker")
+parser.add_argument("--resident", action="store_true", help="Keep the dataset on --device and batch it there, without DataLoader")
 parser.add_argument("--eval", action="store_true")
 parser.add_argument("--checkpoint", type=str, default=None, help="Loading model checkpoint for evaluation")
+parser.add_argument("--quantize", action="store_true", help="With --eval, also evaluate an int8 dynamically quantized copy on CPU")
+parser.add_argument("--export_torchscript", type=str, default=None, help="Save the inference graph of --checkpoint as TorchScript to this path")
+parser.add_argument("--export_onnx", type=str, default=None, help="Save encoder and Gram-Schmidt of --checkpoint as ONNX to this path")
+parser.add_argument("--export_joints", action="store_true", help="Include forward kinematics (joints) in exported models")
+parser.add_argument("--lift_input", type=str, default=None, help="Lift all 2D keypoints of this .npy/.npz file with --checkpoint")
+parser.add_argument("--lift_output", type=str, default="lifted", help="Directory of rotations.npy and joints.npy written by --lift_input")
+parser.add_argument("--lift_key", type=str, default=None, help="Array of the --lift_input .npz archive")
+parser.add_argument("--chunk", type=int, default=65536, help="Frames read, lifted and written at a time by --lift_input")
+parser.add_argument("--lift_workers", type=int, default=0, help="Worker processes sharing --lift_input on CPU, 0 lifts in this process")
+parser.add_argument("--lift_threads", type=int, default=1, help="Torch threads of each --lift_workers process")
 parser.add_argument("--export_training_curves", action="store_true", help="Save train/val curves in .png file")
 parser.add_argument("--dataset", type=str, default="./h36m/data_h36m_frame_all.npz")
+parser.add_argument("--cache_dir", type=str, default=None, help="Preprocessed label cache (default: <dataset dir>/cache, \"\" to disable)")
+parser.add_argument("--rot_format", type=str, default="mat", choices=["mat", "6d", "quat"], \
+                    help="Storage of GT rotations, compact ones are expanded to 3x3 on device in the losses")
 parser.add_argument("--device", default="cuda", help="device used")
 parser.add_argument("--resume", type=str, default=None, help="Loading model checkpoint")
 parser.add_argument("--distributed", action="store_true")
@@ -77,7 +99,7 @@ def train(start_epoch, epoch, train_loader, val_loader,
 
             predicted_3d, w_kc = model(inputs_2d)
 
-            loss_3d_pos = maev(predicted_3d, vec_3d, w_kc) 
+            loss_3d_pos = maev(predicted_3d, vec_3d, w_kc, args.use_orth) 
             epoch_loss_3d_train += vec_3d.shape[0] * loss_3d_pos.item()
             N += vec_3d.shape[0]
 
@@ -102,7 +124,7 @@ def train(start_epoch, epoch, train_loader, val_loader,
 
                 predicted_3d, w_kc = model(inputs_2d)
 
-                loss_3d_pos = maev(predicted_3d, vec_3d, w_kc)
+                loss_3d_pos = maev(predicted_3d, vec_3d, w_kc, args.use_orth)
                 epoch_loss_3d_valid += vec_3d.shape[0] * loss_3d_pos.item()
                 N += vec_3d.shape[0]
 
@@ -136,63 +158,101 @@ def train(start_epoch, epoch, train_loader, val_loader,
     return losses_3d_train , losses_3d_valid
 
 
-def evaluate(test_loader, model, device):
-    epoch_loss_e0 = 0.0
-    epoch_loss_n2 = 0.0
+def evaluate(test_loader, model, device, groups=None, num_groups=1):
+    """
+    :param groups: optional group index (e.g. action) of every batch of test_loader,
+                   to get metrics of num_groups groups from a single pass
+    :return e0, n2: MPJPE and MPBVE in mm, (num_groups,) arrays if groups is given
+    """
+    batch_groups = [0]*len(test_loader) if groups is None else groups
+    epoch_loss_e0 = np.zeros(num_groups)
+    epoch_loss_n2 = np.zeros(num_groups)
+    N = np.zeros(num_groups)
+    model = getattr(model, "module", model)
 
     with torch.no_grad():
-        N = 0
-        for data in test_loader:
+        for g, data in zip(batch_groups, test_loader):
             _, inputs_2d, inputs_3d, vec_3d = data
             inputs_2d = inputs_2d.to(device)
             inputs_3d = inputs_3d.to(device)
             vec_3d = vec_3d.to(device)
 
-            predicted_3d_pos, _ = model(inputs_2d)
-
-            pose_stack = torch.zeros(predicted_3d_pos.size(0),17,3)
-            for b in range(predicted_3d_pos.size(0)):
-                h = Human(1.8, "cpu")
-                pose_stack[b] = h.update_pose(predicted_3d_pos[b].detach().cpu().numpy())
+            predicted_3d_pos, pose_stack = model.infer(inputs_2d, joints=True)
             e0 = mpjpe(pose_stack, inputs_3d)
             n2 = mpbve(predicted_3d_pos, vec_3d, 0)
             
-            epoch_loss_e0 += vec_3d.shape[0] * e0.item()
-            epoch_loss_n2 += vec_3d.shape[0] * n2.item()
-            N += vec_3d.shape[0]
-
-            e0 = (epoch_loss_e0 / N)*1000
-            n2 = (epoch_loss_n2 / N)*1000
-
-    print("Protocol #0 Error (MPJPE):\t", e0, "\t(mm)")
-    print("New Metric #2 Error (MPBVE):\t", n2, "\t(mm)")
+            epoch_loss_e0[g] += vec_3d.shape[0] * e0.item()
+            epoch_loss_n2[g] += vec_3d.shape[0] * n2.item()
+            N[g] += vec_3d.shape[0]
+
+    with np.errstate(invalid="ignore"):
+        # NaN for groups without batches
+        e0 = (epoch_loss_e0 / N)*1000
+        n2 = (epoch_loss_n2 / N)*1000
+    if groups is not None:
+        return e0, n2
+
+    print("Protocol #0 Error (MPJPE):\t", e0[0], "\t(mm)")
+    print("New Metric #2 Error (MPBVE):\t", n2[0], "\t(mm)")
     print("----------")
     
-    return e0, n2
+    return e0[0], n2[0]
 
 
-def run_evaluation(model, actions=None):
-    """ Evalution on Human3.6M dataset """
-    error_e0 = []
-    errors_n2 = []
+def run_evaluation(model, actions=None, device=None):
+    """
+    Evalution on Human3.6M dataset
+    :param device: where the model runs, default --device
+    :return e0, n2: MPJPE and MPBVE in mm (action-wise averages on Human3.6M)
+    """
+    device = args.device if device is None else device
     if actions is not None:
-        # evaluting on h36m
-        for action in actions:
-            test_dataset = Data(args.dataset, train=False, action=action)
-            test_loader = DataLoader(test_dataset, batch_size=512, drop_last=True, shuffle=False, \
-                                    num_workers=args.num_workers, collate_fn=collate_fn)
+        # evaluting on h36m: load the test subjects once, batch each action separately
+        test_dataset = Data(args.dataset, train=False, cache_dir=args.cache_dir, rot_format=args.rot_format)
+        missing = [action for action in actions if action not in test_dataset.action_names]
+        assert not missing, "Unknown actions {}, the test set has {}".format(missing, test_dataset.action_names)
+        batches, groups = [], []
+        for a, action in enumerate(actions):
+            indices = test_dataset.indices(action)
+            for k in range(0, len(indices)-511, 512):
+                batches.append(indices[k:k+512])
+                groups.append(a)
+        test_loader = get_loader(test_dataset, batches=batches)
+        error_e0, errors_n2 = evaluate(test_loader, model, device, groups, len(actions))
+        # incomplete batches are dropped, actions with less than one batch of frames have no error
+        evaluated = [a for a in range(len(actions)) if a in groups]
+        for a, action in enumerate(actions):
             print("-----"+action+"-----")
-            e0, n2 = evaluate(test_loader, model, args.device)
-            error_e0.append(e0)
-            errors_n2.append(n2)
+            if a not in evaluated:
+                print("Skipped: fewer than 512 test frames")
+                print("----------")
+                continue
+            print("Protocol #0 Error (MPJPE):\t", error_e0[a], "\t(mm)")
+            print("New Metric #2 Error (MPBVE):\t", errors_n2[a], "\t(mm)")
+            print("----------")
+        if len(evaluated) < len(actions):
+            print("INFO: Averages over the {} of {} evaluated actions".format(len(evaluated), len(actions)))
+        error_e0, errors_n2 = error_e0[evaluated], errors_n2[evaluated]
         print("Protocol #1   (MPJPE) action-wise average:", round(np.mean(error_e0), 1), "(mm)")
         print("New Metric #2   (MPBVE) action-wise average:", round(np.mean(errors_n2), 1), "(mm)")
+        return np.mean(error_e0), np.mean(errors_n2)
     else:
         # evaluting on MPI-INF-3DHP
-        test_dataset = Data(args.dataset, train=False)
-        test_loader = DataLoader(test_dataset, batch_size=512, drop_last=True,
-                                num_workers=args.num_workers, collate_fn=collate_fn)
-        e0, n2 = evaluate(test_loader, model, args.device)
+        test_dataset = Data(args.dataset, train=False, cache_dir=args.cache_dir, rot_format=args.rot_format)
+        test_loader = get_loader(test_dataset, 512, drop_last=True)
+        return evaluate(test_loader, model, device)
+
+
+def get_loader(dataset, batch_size=None, **kwargs):
+    """ batch_loader, or a ResidentLoader on --device if --resident is set """
+    if args.resident:
+        if getattr(dataset, "device", None) is None:
+            dataset.to(args.device)
+        return ResidentLoader(dataset, batch_size, **kwargs)
+    if args.num_workers > 0:
+        kwargs.update(persistent_workers=args.persistent_workers, prefetch_factor=args.prefetch_factor)
+    return batch_loader(dataset, batch_size, num_workers=args.num_workers, \
+                        pin_memory=args.pin_memory, **kwargs)
 
 
 def set_random_seeds(random_seed=0):
@@ -206,9 +266,40 @@ def set_random_seeds(random_seed=0):
 
 def main(args):
     device = torch.device(args.device)
-    model = PEBRT(device, bs=args.bs, num_layers=args.num_layers)
+    model = PEBRT(device, bs=args.bs, num_layers=args.num_layers, per_sample=not args.legacy_attention)
     print("INFO: Using PEBRT and Gram-Schmidt process to recover SO(3) rotation matrix")
     ddp_model = model.to(device)
+
+    if args.export_torchscript or args.export_onnx:
+        # export mode
+        if args.checkpoint:
+            load_checkpoint(model, args.checkpoint, args.legacy_attention)
+        if args.export_torchscript:
+            save_torchscript(model, args.export_torchscript, args.export_joints)
+        if args.export_onnx:
+            save_onnx(model, args.export_onnx)
+            try:
+                import onnxruntime
+            except ImportError:
+                print("INFO: onnxruntime is not installed, the exported graph is not checked")
+            else:
+                check_onnx(model, args.export_onnx)
+        return
+
+    if args.lift_input:
+        # bulk lifting mode
+        kwargs = dict(quantized=args.quantize, legacy_attention=args.legacy_attention, max_batch=args.chunk)
+        if args.lift_workers > 0:
+            # the pool shuts its workers down also on errors and Ctrl-C
+            with PoseLifterPool.from_checkpoint(args.checkpoint, args.num_layers, "cpu", \
+                        num_workers=args.lift_workers, num_threads=args.lift_threads, **kwargs) as lifter:
+                N = lifter.lift_archive(args.lift_input, args.lift_output, args.chunk, args.lift_key)
+        else:
+            lifter = PoseLifter.from_checkpoint(args.checkpoint, args.num_layers, device, **kwargs)
+            N = lifter.lift_archive(args.lift_input, args.lift_output, args.chunk, args.lift_key)
+        print("INFO: {} frames lifted to {}".format(N, args.lift_output))
+        return
+
     print("INFO: Model loaded on {}".format(torch.cuda.get_device_name(torch.cuda.current_device())))
     print("INFO: Training using dataset {}".format(args.dataset))
 
@@ -219,7 +310,7 @@ def main(args):
         set_random_seeds(random_seed=random_seed)
         torch.distributed.init_process_group(backend="nccl")
         device = torch.device("cuda:{}".format(local_rank))
-        model = PEBRT(device, bs=args.bs)
+        model = PEBRT(device, bs=args.bs, per_sample=not args.legacy_attention)
         ddp_model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[local_rank], output_device=local_rank)
 
     model_params = 0
@@ -229,44 +320,49 @@ def main(args):
 
     if args.eval:
         # evaluation mode
-        ddp_model.load_state_dict(torch.load(args.checkpoint)["model"])
+        load_checkpoint(model, args.checkpoint, args.legacy_attention)
         ddp_model.eval()
+        actions = None
         if "h36m" in args.dataset:
             actions = ["Directions", "Discussion", "Eating", "Greeting", "Phoning",
                     "Photo",  "Posing", "Purchases", "Sitting", "SittingDown", 
                     "Smoking", "Waiting", "Walking", "WalkDog", "WalkTogether"]
             print("Evaluation on Human3.6M starts...")
-            run_evaluation(ddp_model, actions)
         else:
             print("Evaluation on MPI-INF-3DHP starts...")
-            run_evaluation(ddp_model)
+        e0, n2 = run_evaluation(ddp_model, actions)
+
+        if args.quantize:
+            print("Evaluation of the int8 quantized model on CPU starts...")
+            q_e0, q_n2 = run_evaluation(quantize(model), actions, "cpu")
+            print("Quantized - float MPJPE:", round(q_e0 - e0, 2), "(mm)\tMPBVE:", round(q_n2 - n2, 2), "(mm)")
 
     else:
         # training mode
-        train_dataset = Data(args.dataset)
-        val_dataset = Data(args.dataset, train=False)
+        train_dataset = Data(args.dataset, cache_dir=args.cache_dir, rot_format=args.rot_format)
+        val_dataset = Data(args.dataset, train=False, cache_dir=args.cache_dir, rot_format=args.rot_format)
+        if args.resident:
+            train_dataset.to(device)
+            val_dataset.to(device)
 
         if args.distributed:
             from torch.utils.data.distributed import DistributedSampler
             train_sampler = DistributedSampler(dataset=train_dataset)
-            train_loader = DataLoader(train_dataset, batch_size=args.bs, \
-                num_workers=args.num_workers, sampler=train_sampler)
-            val_loader = DataLoader(val_dataset, batch_size=args.bs, shuffle=False, \
-                    num_workers=args.num_workers, drop_last=True, collate_fn=collate_fn)
+            train_loader = get_loader(train_dataset, args.bs, sampler=train_sampler)
+            val_loader = get_loader(val_dataset, args.bs, shuffle=False, drop_last=True)
 
         else:
             local_rank = 0
-            train_loader = DataLoader(train_dataset, batch_size=args.bs, shuffle=False, \
-                num_workers=args.num_workers, drop_last=True, collate_fn=collate_fn)
-            val_loader = DataLoader(val_dataset, batch_size=args.bs, shuffle=False, \
-                num_workers=args.num_workers, drop_last=True, collate_fn=collate_fn)
+            train_loader = get_loader(train_dataset, args.bs, shuffle=False, drop_last=True)
+            val_loader = get_loader(val_dataset, args.bs, shuffle=False, drop_last=True)
 
         optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
         lr_scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=args.lr_drop)
 
         if args.resume:
-            checkpoint = torch.load(args.resume, map_location="cpu")
-            model.load_state_dict(checkpoint["model"])
+            checkpoint = load_checkpoint(model, args.resume, args.legacy_attention)
+            # saved with later checkpoints of this run
+            args.legacy_attention = not model.transformer.per_sample
 
             if not args.eval and "optimizer" in checkpoint and "lr_scheduler" in checkpoint and "epoch" in checkpoint:
                 optimizer.load_state_dict(checkpoint["optimizer"])
@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+"""
+Lifting service: loads a checkpoint once and lifts 2D keypoints sent over local HTTP (TCP or Unix socket).
+Concurrent requests are coalesced into one batched forward on a worker thread.
+
+    POST /lift      {"kpts": (n,17,2) or (17,2) nested lists} as JSON, or raw float32 (n,17,2)
+                    with Content-Type: application/octet-stream.
+                    Returns {"rotations": (n,16,9), "joints": (n,17,3)} as JSON, or raw float32 rotations
+                    followed by joints with Accept: application/octet-stream.
+    GET /metrics    request latency and batch size histograms (Prometheus text format)
+"""
+from common.lifter import PoseLifter
+
+import argparse
+import asyncio
+import json
+import os
+import stat
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+parser = argparse.ArgumentParser("PEBRT lifting service")
+
+parser.add_argument("--checkpoint", type=str, required=True, help="Trained weights")
+parser.add_argument("--num_layers", type=int, default=2)
+parser.add_argument("--device", default="cpu", help="device used")
+parser.add_argument("--quantize", action="store_true", help="int8 dynamic quantization, runs on CPU")
+parser.add_argument("--legacy_attention", action="store_true")
+parser.add_argument("--host", type=str, default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8000)
+parser.add_argument("--unix", type=str, default=None, help="Listen on this Unix socket instead of --host/--port")
+parser.add_argument("--max_batch", type=int, default=256, help="Frames per coalesced forward")
+parser.add_argument("--max_wait", type=float, default=0.005, help="Seconds a forward waits for more requests")
+
+args = parser.parse_args()
+
+BINARY = "application/octet-stream"
+
+
+
+class Histogram:
+    """ cumulative histogram in Prometheus text format """
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0]*len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, value):
+        for k, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[k] += 1
+        self.count += 1
+        self.sum += value
+
+
+    def render(self) -> str:
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} histogram".format(self.name)]
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, count))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name, self.count))
+        lines.append("{}_sum {}".format(self.name, self.sum))
+        lines.append("{}_count {}".format(self.name, self.count))
+        return "\n".join(lines) + "\n"
+
+
+class Counter:
+    """ counter in Prometheus text format """
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+
+    def inc(self):
+        self.value += 1
+
+
+    def render(self) -> str:
+        return "# HELP {0} {1}\n# TYPE {0} counter\n{0} {2}\n".format(self.name, self.description, self.value)
+
+
+class LiftingService:
+    """
+    HTTP front end and request coalescing around a PoseLifter
+    """
+    def __init__(self, lifter, max_batch=256, max_wait=0.005):
+        self.lifter = lifter
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        # a single thread keeps forwards sequential and off the event loop
+        self.executor = ThreadPoolExecutor(1)
+        self.latency = Histogram("lift_request_seconds", "Latency of /lift requests",
+                                (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+        self.batch_size = Histogram("lift_batch_frames", "Frames per coalesced forward",
+                                (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+        self.failures = Counter("lift_request_failures_total", "/lift requests that failed in the model")
+        self.queue = None
+        self.coalescer = None
+
+
+    async def lift(self, kpts):
+        """
+        :param kpts: (n,17,2) float32 array
+        :return rotations (n,16,9), joints (n,17,3) arrays
+        """
+        if self.coalescer.done():
+            raise RuntimeError("request coalescing has stopped")
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((kpts, future))
+        return await future
+
+
+    def stopped(self, coalescer):
+        """ fail the queued requests instead of letting them wait forever """
+        error = RuntimeError("request coalescing has stopped")
+        if not coalescer.cancelled() and coalescer.exception() is not None:
+            error = coalescer.exception()
+        while not self.queue.empty():
+            _, future = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(error)
+
+
+    async def coalesce(self):
+        """ forward queued requests in batches of up to max_batch frames """
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            size = len(requests[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                size += len(request[0])
+
+            kpts = np.concatenate([request[0] for request in requests])
+            self.batch_size.observe(len(kpts))
+            try:
+                R_stack, joints = await loop.run_in_executor(self.executor, self.lifter.lift, kpts)
+            except Exception as e:
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            start = 0
+            for request_kpts, future in requests:
+                end = start + len(request_kpts)
+                if not future.done():
+                    future.set_result((R_stack[start:end].numpy(), joints[start:end].numpy()))
+                start = end
+
+
+    async def route(self, method, path, headers, body):
+        """ :return status, content type, payload """
+        if method == "GET" and path == "/metrics":
+            return "200 OK", "text/plain; version=0.0.4", (self.latency.render() + self.batch_size.render() + self.failures.render()).encode()
+        if method != "POST" or path != "/lift":
+            return "404 Not Found", "text/plain", b"not found\n"
+
+        start = perf_counter()
+        try:
+            if headers.get("content-type", "").startswith(BINARY):
+                kpts = np.frombuffer(body, dtype=np.float32).reshape(-1,17,2)
+            else:
+                kpts = np.asarray(json.loads(body)["kpts"], dtype=np.float32).reshape(-1,17,2)
+        except (ValueError, KeyError, TypeError) as e:
+            return "400 Bad Request", "text/plain", "{}\n".format(e).encode()
+        if len(kpts) == 0:
+            return "400 Bad Request", "text/plain", b"no keypoints\n"
+
+        try:
+            R_stack, joints = await self.lift(kpts)
+        except Exception as e:
+            # e.g. out of memory, set on every request of the failed batch by coalesce
+            self.failures.inc()
+            return "500 Internal Server Error", "text/plain", "{}: {}\n".format(type(e).__name__, e).encode()
+        if headers.get("accept", "").startswith(BINARY):
+            response = BINARY, R_stack.tobytes() + joints.tobytes()
+        else:
+            response = "application/json", json.dumps({"rotations": R_stack.tolist(), "joints": joints.tolist()}).encode()
+        self.latency.observe(perf_counter() - start)
+        return ("200 OK",) + response
+
+
+    async def handle(self, reader, writer):
+        """ HTTP/1.1 connection, kept alive until the client closes it """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode().split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, content_type, payload = await self.route(method, path, headers, body)
+                writer.write("HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n".format(
+                                status, content_type, len(payload)).encode() + payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def serve(self, host="127.0.0.1", port=8000, unix=None):
+        self.queue = asyncio.Queue()
+        self.coalescer = asyncio.ensure_future(self.coalesce())
+        self.coalescer.add_done_callback(self.stopped)
+        if unix:
+            if os.path.exists(unix) and stat.S_ISSOCK(os.stat(unix).st_mode):
+                # left behind by a previous run that did not shut down cleanly
+                os.unlink(unix)
+            server = await asyncio.start_unix_server(self.handle, path=unix)
+            print("INFO: Serving on unix:{}".format(unix))
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            print("INFO: Serving on http://{}:{}".format(host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.coalescer.cancel()
+            if unix and os.path.exists(unix):
+                os.unlink(unix)
+
+
+if __name__ == "__main__":
+    lifter = PoseLifter.from_checkpoint(args.checkpoint, args.num_layers, args.device, quantized=args.quantize, \
+                        legacy_attention=args.legacy_attention, max_batch=args.max_batch)
+    # with legacy attention the lifter runs the coalesced frames one by one (see PoseLifter)
+    service = LiftingService(lifter, args.max_batch, args.max_wait)
+    asyncio.run(service.serve(args.host, args.port, args.unix))